@@ -5,8 +5,11 @@
 # run only once at the beginning of the project setup.
 
 import os
+import sys
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
 # Carica le variabili d'ambiente dal file .env.
@@ -18,11 +21,38 @@ AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT")
 AZURE_SEARCH_API_KEY = os.getenv("AZURE_SEARCH_API_KEY")
 AZURE_SEARCH_INDEX_NAME = os.getenv("AZURE_SEARCH_INDEX_NAME")
 # Usa una versione stabile dell'API per coerenza e per evitare modifiche che potrebbero rompere il codice.
-API_VERSION = "2023-11-01"
+# La versione 2024-07-01 è la prima GA a supportare la compressione dei vettori ('compressions').
+API_VERSION = "2024-07-01"
+# Tipo di compressione dei vettori nel grafo HNSW: "scalar" (int8, 4x), "binary" (1 bit per dimensione, 32x) o "none".
+VECTOR_COMPRESSION = os.getenv("AZURE_SEARCH_VECTOR_COMPRESSION", "scalar").lower()
+
+# --- Parametri dell'Algoritmo HNSW ---
+# Governano il compromesso tra recall, latenza e memoria del grafo. Azure accetta 'm' tra 4 e 10,
+# 'efConstruction' e 'efSearch' tra 100 e 1000.
+# 'm': numero di archi per nodo (grafo più denso = recall più alta, più memoria).
+HNSW_M = int(os.getenv("AZURE_SEARCH_HNSW_M", "10"))
+# 'efConstruction': ampiezza della lista dei candidati durante la costruzione del grafo (solo costo di indicizzazione).
+HNSW_EF_CONSTRUCTION = int(os.getenv("AZURE_SEARCH_HNSW_EF_CONSTRUCTION", "400"))
+# 'efSearch': ampiezza della lista dei candidati durante la ricerca (recall contro latenza di ogni query).
+HNSW_EF_SEARCH = int(os.getenv("AZURE_SEARCH_HNSW_EF_SEARCH", "100"))
+
+# Precisione con cui l'indice memorizza i vettori originali: "half" (Edm.Half, 16 bit) dimezza spazio e
+# banda rispetto a "single" (Edm.Single, 32 bit) con un impatto trascurabile sulla recall per vettori normalizzati.
+VECTOR_PRECISION = os.getenv("AZURE_SEARCH_VECTOR_PRECISION", "half").lower()
+VECTOR_FIELD_TYPES = {"half": "Collection(Edm.Half)", "single": "Collection(Edm.Single)"}
+
+# Dimensioni dei vettori: devono coincidere con l'output del modello di embedding (vedi embedding.py).
+# 'paraphrase-multilingual-MiniLM-L12-v2' produce vettori a 384 dimensioni; con un modello Matryoshka
+# troncato tramite EMBEDDING_DIMENSIONS (es. 256) l'indice usa lo stesso valore.
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "384"))
 
 # Valida che tutte le variabili d'ambiente richieste siano impostate prima di procedere.
 if not all([AZURE_SEARCH_ENDPOINT, AZURE_SEARCH_API_KEY, AZURE_SEARCH_INDEX_NAME]):
     raise ValueError("Una o più variabili d'ambiente non sono impostate. Controlla il tuo file .env.")
+if VECTOR_COMPRESSION not in ("scalar", "binary", "none"):
+    raise ValueError(f"AZURE_SEARCH_VECTOR_COMPRESSION non valida: '{VECTOR_COMPRESSION}'. Valori ammessi: scalar, binary, none.")
+if VECTOR_PRECISION not in VECTOR_FIELD_TYPES:
+    raise ValueError(f"AZURE_SEARCH_VECTOR_PRECISION non valida: '{VECTOR_PRECISION}'. Valori ammessi: half, single.")
 
 # Costruisce l'URL completo per l'endpoint dell'API REST per creare/aggiornare un indice.
 url = f"{AZURE_SEARCH_ENDPOINT}/indexes/{AZURE_SEARCH_INDEX_NAME}?api-version={API_VERSION}"
@@ -33,6 +63,35 @@ headers = {
     "api-key": AZURE_SEARCH_API_KEY
 }
 
+# --- Configurazione della Compressione dei Vettori ---
+# Entrambe le compressioni riducono la memoria del grafo HNSW, che è il collo di bottiglia della ricerca.
+# I vettori originali restano memorizzati nella precisione VECTOR_PRECISION (Edm.Half con "half", Edm.Single
+# con "single"): Azure recupera k * 'defaultOversampling' candidati con i vettori compressi e li riordina con
+# gli originali, recuperando quasi tutta la qualità persa.
+COMPRESSIONS = [
+    # Quantizzazione scalare: ogni dimensione diventa un int8 (4 volte meno memoria).
+    {
+        "name": "my-scalar-quantization",
+        "kind": "scalarQuantization",
+        "rerankWithOriginalVectors": True,
+        "defaultOversampling": 4,
+        "scalarQuantizationParameters": {"quantizedDataType": "int8"},
+    },
+    # Quantizzazione binaria: ogni dimensione diventa un bit (32 volte meno memoria, distanza di Hamming).
+    # Perde più qualità della scalare, quindi l'oversampling per il riordino è più alto.
+    {
+        "name": "my-binary-quantization",
+        "kind": "binaryQuantization",
+        "rerankWithOriginalVectors": True,
+        "defaultOversampling": 10,
+    },
+]
+COMPRESSION_PROFILE = {
+    "scalar": {"compression": "my-scalar-quantization"},
+    "binary": {"compression": "my-binary-quantization"},
+    "none": {},
+}[VECTOR_COMPRESSION]
+
 # --- Definizione dello Schema dell'Indice ---
 # Questo oggetto JSON definisce la struttura (schema) dell'indice di ricerca. Specifica i campi,
 # i loro tipi e la configurazione della ricerca vettoriale.
@@ -48,43 +107,109 @@ index_body = {
         {"name": "content", "type": "Edm.String", "searchable": True},
         
         # Il campo 'content_vector' memorizza l'embedding vettoriale del contenuto.
-        # 'type': 'Collection(Edm.Single)' specifica un array di numeri float a precisione singola.
+        # 'type' è un array di float a mezza precisione ('Collection(Edm.Half)') o a precisione singola ('Collection(Edm.Single)').
         {
             "name": "content_vector",
-            "type": "Collection(Edm.Single)",
+            "type": VECTOR_FIELD_TYPES[VECTOR_PRECISION],
             "searchable": True,
             # 'dimensions' DEVE corrispondere alle dimensioni di output del modello di embedding.
-            # 'paraphrase-multilingual-MiniLM-L12-v2' produce vettori a 384 dimensioni.
-            "dimensions": 384,
+            "dimensions": EMBEDDING_DIMENSIONS,
             "vectorSearchProfile": "my-hnsw-profile",
         },
     ],
     "vectorSearch": {
         # 'profiles' definisce configurazioni nominate per la ricerca vettoriale.
         "profiles": [
-            {"name": "my-hnsw-profile", "algorithm": "my-hnsw-config"}
+            {"name": "my-hnsw-profile", "algorithm": "my-hnsw-config", **COMPRESSION_PROFILE}
         ],
         # 'algorithms' definisce gli algoritmi di ricerca vettoriale. HNSW (Hierarchical Navigable Small World)
         # è un algoritmo ad alte prestazioni utilizzato per la ricerca approssimata dei vicini più prossimi.
         "algorithms": [
-            {"name": "my-hnsw-config", "kind": "hnsw"}
+            {
+                "name": "my-hnsw-config",
+                "kind": "hnsw",
+                "hnswParameters": {
+                    "m": HNSW_M,
+                    "efConstruction": HNSW_EF_CONSTRUCTION,
+                    "efSearch": HNSW_EF_SEARCH,
+                    # Documenti e query vengono normalizzati a lunghezza unitaria prima del caricamento,
+                    # quindi il prodotto scalare coincide con il coseno ma evita il calcolo delle norme.
+                    "metric": "dotProduct",
+                },
+            }
         ],
+        # 'compressions' definisce le quantizzazioni disponibili; il profilo usa quella scelta in VECTOR_COMPRESSION.
+        "compressions": COMPRESSIONS,
     },
 }
 
+def differenze_schema_vettoriale(indice_esistente: dict) -> list[str]:
+    """
+    Confronta la configurazione vettoriale di un indice esistente con quella di 'index_body'.
+    Tipo e dimensioni del campo vettoriale, metrica e compressione del profilo non possono essere modificati
+    su un indice esistente: Azure rifiuta l'aggiornamento, oppure l'indice resta incoerente con i vettori
+    caricati da 02_popola_indice.py.
+
+    Args:
+        indice_esistente (dict): La definizione dell'indice restituita da Azure AI Search.
+
+    Returns:
+        list[str]: Le differenze trovate, descritte a parole (vuota se la configurazione coincide).
+    """
+    atteso = next(f for f in index_body["fields"] if f["name"] == "content_vector")
+    campo = next((f for f in indice_esistente.get("fields", []) if f["name"] == "content_vector"), None)
+    if campo is None:
+        return ["campo 'content_vector' assente"]
+    differenze = []
+    for chiave in ("type", "dimensions"):
+        if campo.get(chiave) != atteso[chiave]:
+            differenze.append(f"{chiave} del campo vettoriale: {campo.get(chiave)} -> {atteso[chiave]}")
+
+    ricerca = indice_esistente.get("vectorSearch") or {}
+    profilo = next((p for p in ricerca.get("profiles", []) if p["name"] == campo.get("vectorSearchProfile")), {})
+    algoritmo = next((a for a in ricerca.get("algorithms", []) if a["name"] == profilo.get("algorithm")), {})
+    metrica = (algoritmo.get("hnswParameters") or {}).get("metric")
+    if metrica != "dotProduct":
+        differenze.append(f"metrica: {metrica} -> dotProduct")
+    if profilo.get("compression") != COMPRESSION_PROFILE.get("compression"):
+        differenze.append(f"compressione: {profilo.get('compression')} -> {COMPRESSION_PROFILE.get('compression')}")
+    return differenze
+
+# La sessione riutilizza la connessione e ripete automaticamente le richieste, con attesa esponenziale,
+# quando Azure risponde 429 (throttling) o 503 (servizio temporaneamente non disponibile).
+# Esauriti i tentativi, restituisce comunque l'ultima risposta, gestita dai controlli qui sotto.
+session = requests.Session()
+session.mount("https://", HTTPAdapter(max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 503], raise_on_status=False)))
+
+# --- Controllo dell'Indice Esistente ---
+# La configurazione vettoriale di un indice non può essere aggiornata sul posto: se l'indice esiste già con
+# uno schema vettoriale diverso (es. creato da una versione precedente con Edm.Single e metrica coseno),
+# va eliminato e ricreato, e poi ripopolato con 02_popola_indice.py.
+esistente = session.get(url, headers=headers)
+if esistente.status_code == 200:
+    differenze = differenze_schema_vettoriale(esistente.json())
+    if differenze:
+        print(f"\nERRORE: l'indice '{AZURE_SEARCH_INDEX_NAME}' esiste già con una configurazione vettoriale diversa:")
+        for differenza in differenze:
+            print(f"  - {differenza}")
+        print("Azure AI Search non può modificare questi parametri su un indice esistente. Elimina l'indice")
+        print("(dal portale di Azure o con una richiesta DELETE allo stesso URL), poi esegui di nuovo questo script")
+        print("e 02_popola_indice.py per ricaricare i documenti.")
+        sys.exit(1)
+
 print(f"Invio della richiesta PUT per creare/aggiornare l'indice a: {url}")
 
 # Invia la richiesta ad Azure AI Search per creare o aggiornare l'indice.
 # Una richiesta PUT è idempotente, il che significa che può essere eseguita più volte in sicurezza. Se l'indice
-# esiste già con questo schema, Azure confermerà il successo. Se esiste ma con uno
-# schema diverso, sarà aggiornato. Se non esiste, sarà creato.
-response = requests.put(url, headers=headers, data=json.dumps(index_body))
+# esiste già con questo schema, Azure confermerà il successo; le modifiche ammesse sul posto (es. i parametri
+# HNSW 'efSearch' o nuovi campi) vengono applicate. Se non esiste, sarà creato.
+response = session.put(url, headers=headers, data=json.dumps(index_body))
 
 # Controlla il codice di stato della risposta HTTP per confermare il risultato.
 # I codici di stato 200 (OK) o 201 (Created) indicano il successo.
 if response.status_code in [200, 201]:
     print("\nSUCCESSO: L'indice è stato creato o aggiornato con successo.")
-    print("L'indice è ora configurato per vettori a 384 dimensioni.")
+    print(f"L'indice è ora configurato per vettori a {EMBEDDING_DIMENSIONS} dimensioni (precisione: {VECTOR_PRECISION}, compressione: {VECTOR_COMPRESSION}).")
 else:
     # Se qualcosa è andato storto, stampa il codice di stato dell'errore e il messaggio di errore dettagliato da Azure.
     print(f"\nERRORE: Azure ha risposto con il codice di stato: {response.status_code}")
@@ -5,15 +5,25 @@
 # e carica i dati strutturati nell'indice di Azure AI Search.
 
 import os
-import re
-import uuid
+import copy
+import hashlib
 import io
-import PyPDF2
+import json
+import threading
+import queue
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pypdfium2 as pdfium
+import requests
+from requests.adapters import HTTPAdapter
 from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
+from azure.core.pipeline.transport import RequestsTransport
+from azure.search.documents import SearchClient, SearchIndexingBufferedSender
 from azure.storage.blob import BlobServiceClient
 from dotenv import load_dotenv
-from sentence_transformers import SentenceTransformer
+from embedding import load_embedding_model
 
 # Carica le variabili d'ambiente.
 load_dotenv()
@@ -25,124 +35,661 @@ AZURE_SEARCH_INDEX_NAME = os.getenv("AZURE_SEARCH_INDEX_NAME")
 AZURE_STORAGE_CONNECTION_STRING = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
 AZURE_STORAGE_CONTAINER_NAME = os.getenv("AZURE_STORAGE_CONTAINER_NAME")
 
+# Numero di chunk codificati insieme in un singolo forward pass del modello di embedding.
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+# Numero di documenti inviati ad Azure AI Search in ogni richiesta di indicizzazione.
+# Azure accetta al massimo 1000 documenti e 16 MB per richiesta: con chunk da 120 token e vettori a 384
+# dimensioni un blocco da 1000 resta ampiamente sotto i 16 MB, e se un blocco risultasse comunque troppo
+# grande (HTTP 413) il sender lo divide a metà e riprova da solo.
+UPLOAD_BATCH_SIZE = int(os.getenv("AZURE_SEARCH_UPLOAD_BATCH_SIZE", "1000"))
+if not 1 <= UPLOAD_BATCH_SIZE <= 1000:
+    raise ValueError(f"AZURE_SEARCH_UPLOAD_BATCH_SIZE non valido: {UPLOAD_BATCH_SIZE}. Azure accetta da 1 a 1000 documenti per richiesta.")
+# Dimensione massima dei chunk e sovrapposizione tra chunk consecutivi, in token del modello di embedding.
+# Il modello considera al massimo 'max_seq_length' token (128, di cui 2 speciali): il testo oltre questo
+# limite verrebbe troncato in silenzio, costando calcolo senza contribuire all'embedding.
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "120"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "16"))
+# Numero di blob scaricati ed estratti in parallelo.
+BLOB_WORKERS = int(os.getenv("BLOB_WORKERS", "8"))
+# Connessioni parallele usate per scaricare un singolo blob di grandi dimensioni (oltre i 32 MB, a blocchi).
+BLOB_DOWNLOAD_CONCURRENCY = int(os.getenv("BLOB_DOWNLOAD_CONCURRENCY", "4"))
+# Capienza delle code tra le fasi della pipeline: blob già elaborati in attesa dell'embedding
+# (oltre a quelli in lavorazione) e blocchi di documenti in attesa del caricamento. Limita la RAM usata.
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "4"))
+# Precisione dei vettori nell'indice (vedi 01_crea_indice.py): con "half" gli embedding vengono convertiti
+# in float16 prima dell'invio, così il payload corrisponde a ciò che l'indice memorizza ed è più leggero.
+VECTOR_PRECISION = os.getenv("AZURE_SEARCH_VECTOR_PRECISION", "half").lower()
+# Distanza di Hamming massima (su 64 bit) tra le SimHash di due chunk considerati quasi identici.
+# 6 bit su 64 corrispondono a una somiglianza di circa il 90%; un valore negativo disattiva la deduplicazione.
+DEDUP_MAX_DISTANCE = int(os.getenv("DEDUP_MAX_DISTANCE", "6"))
+# File in cui viene salvato l'ETag di ogni blob elaborato: alla successiva esecuzione i blob con lo stesso
+# ETag (cioè non modificati) non vengono né scaricati né rielaborati. Una stringa vuota disattiva il checkpoint.
+BLOB_CHECKPOINT_FILE = os.getenv("BLOB_CHECKPOINT_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "blob_checkpoint.json"))
+
 # Carica il modello di embedding locale.
 print("🔎 Caricamento del modello di embedding locale...")
-embedding_model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
+# Il backend di inferenza (PyTorch, ONNX Runtime o OpenVINO) si sceglie con EMBEDDING_BACKEND.
+embedding_model = load_embedding_model()
 print("✅ Modello di embedding locale caricato.")
+if CHUNK_SIZE > embedding_model.max_seq_length - 2:
+    print(f"Attenzione: CHUNK_SIZE={CHUNK_SIZE} supera i {embedding_model.max_seq_length - 2} token elaborati dal modello. I chunk verranno troncati.")
+
+# Copia privata del tokenizer, usata solo per misurare i chunk. Il chunking gira sui thread del pool mentre
+# il thread principale codifica: il tokenizer del modello cambia le proprie impostazioni di troncamento
+# a ogni chiamata e non va condiviso. Senza troncamento, la copia conta tutti i token del testo.
+_chunk_tokenizer = copy.deepcopy(embedding_model.tokenizer.backend_tokenizer)
+_chunk_tokenizer.no_truncation()
+_chunk_tokenizer.no_padding()
+
+def count_tokens(text: str) -> int:
+    """
+    Conta i token del testo secondo il tokenizer del modello di embedding, esclusi i token speciali.
+
+    Args:
+        text (str): Il testo da misurare.
+
+    Returns:
+        int: Il numero di token.
+    """
+    return len(_chunk_tokenizer.encode(text, add_special_tokens=False).ids)
 
-# Inizializza i client dei servizi Azure.
+# Inizializza i client dei servizi Azure. Il SearchClient serve solo a leggere gli ID già indicizzati:
+# il caricamento usa un SearchIndexingBufferedSender, creato nel blocco principale.
 search_client = SearchClient(endpoint=AZURE_SEARCH_ENDPOINT, index_name=AZURE_SEARCH_INDEX_NAME, credential=AzureKeyCredential(AZURE_SEARCH_API_KEY))
-blob_service_client = BlobServiceClient.from_connection_string(AZURE_STORAGE_CONNECTION_STRING)
+# Il pool di connessioni predefinito di requests ne mantiene 10 per host: con più download in parallelo
+# le connessioni in eccesso verrebbero chiuse e riaperte (con un nuovo handshake TLS) a ogni richiesta.
+_blob_session = requests.Session()
+_blob_session.mount("https://", HTTPAdapter(pool_maxsize=BLOB_WORKERS * BLOB_DOWNLOAD_CONCURRENCY))
+blob_service_client = BlobServiceClient.from_connection_string(
+    AZURE_STORAGE_CONNECTION_STRING, transport=RequestsTransport(session=_blob_session)
+)
 
 # --- Funzioni di Elaborazione del Testo ---
 
-def read_text_from_pdf_stream(stream: io.BytesIO) -> str:
+# Separatori usati per la suddivisione in chunk, dal più grossolano (paragrafo) al più fine (parola).
+_SEPARATORS = ["\n\n", "\n", ". ", " "]
+
+# Serializza le chiamate a PDFium, che non supporta l'uso concorrente da più thread.
+_PDFIUM_LOCK = threading.Lock()
+
+# Estensioni dei file che lo script sa elaborare: gli altri blob non vengono nemmeno scaricati.
+SUPPORTED_EXTENSIONS = ('.pdf', '.txt')
+# Firma iniziale di un file PDF. Lo standard ammette byte spuri prima dell'intestazione, quindi
+# la firma viene cercata nei primi PDF_HEADER_BYTES byte invece che solo all'inizio del file.
+PDF_MAGIC = b"%PDF-"
+PDF_HEADER_BYTES = 1024
+
+def iter_pdf_pages(stream: io.BytesIO) -> Iterator[str]:
     """
-    Estrae tutto il testo da un file PDF fornito come stream di byte.
+    Estrae il testo di un file PDF una pagina alla volta, senza costruire la stringa dell'intero documento.
+    Usa PDFium (tramite pypdfium2), implementato in C++ e molto più veloce di un parser in puro Python.
     
     Args:
         stream (io.BytesIO): Lo stream di byte del file PDF.
         
+    Yields:
+        str: Il contenuto testuale di ciascuna pagina, nell'ordine del documento.
+    """
+    # PDFium non è thread-safe: ogni chiamata a PDFium (apertura, estrazione di una pagina, chiusura) avviene
+    # sotto il lock, mentre i download dei blob continuano in parallelo sugli altri thread del pool. Il lock viene
+    # rilasciato prima di restituire ogni pagina, così chunking e tokenizzazione del consumatore non bloccano
+    # l'estrazione dei PDF degli altri thread.
+    with _PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(stream)
+        n_pages = len(pdf)
+    try:
+        for index in range(n_pages):
+            with _PDFIUM_LOCK:
+                page = pdf[index]
+                textpage = page.get_textpage()
+                text = textpage.get_text_range()
+                # Libera subito le strutture native della pagina: con PDF di centinaia di pagine
+                # non restano in memoria fino alla chiusura del documento.
+                textpage.close()
+                page.close()
+            yield text
+    finally:
+        with _PDFIUM_LOCK:
+            pdf.close()
+
+def _split_on_separators(text: str, max_chunk_size: int, separators: list[str], length_function: Callable[[str], int]) -> list[str]:
+    """
+    Divide ricorsivamente il testo in pezzi non più lunghi di 'max_chunk_size', usando il separatore
+    più "grossolano" possibile (paragrafo, riga, frase, parola) e passando al successivo solo per i
+    pezzi ancora troppo lunghi. I separatori restano attaccati ai pezzi, così il testo non perde punteggiatura.
+
+    Args:
+        text (str): Il testo da dividere.
+        max_chunk_size (int): La lunghezza massima di ogni pezzo, misurata con 'length_function'.
+        separators (list[str]): I separatori da provare, dal più grossolano al più fine.
+        length_function (Callable[[str], int]): La funzione che misura la lunghezza di un testo.
+
+    Returns:
+        list[str]: I pezzi di testo, nell'ordine originale.
+    """
+    if length_function(text) <= max_chunk_size:
+        return [text]
+    if not separators:
+        # Nessun separatore utile (es. una "parola" lunghissima): taglio a lunghezza fissa come ultima risorsa.
+        # Ogni token del tokenizer SentencePiece copre almeno un carattere, ma all'inizio del pezzo può comparire
+        # un token "▁" a sé stante: 'max_chunk_size - 1' caratteri rientrano quindi nel limite.
+        step = max(max_chunk_size - 1, 1)
+        return [text[i:i + step] for i in range(0, len(text), step)]
+
+    separator, finer_separators = separators[0], separators[1:]
+    parts = text.split(separator)
+    pieces = []
+    for i, part in enumerate(parts):
+        if i < len(parts) - 1:
+            part += separator
+        if part:
+            pieces.extend(_split_on_separators(part, max_chunk_size, finer_separators, length_function))
+    return pieces
+
+def _normalize_whitespace(text: str) -> str:
+    """
+    Riduce ogni sequenza di spazi bianchi (spazi, tab, a capo) a un singolo spazio e rimuove quelli iniziali e finali.
+    'str.split' senza argomenti scorre il testo una sola volta in C, più velocemente di un'espressione regolare.
+
+    Args:
+        text (str): Il testo da normalizzare.
+
     Returns:
-        str: Il contenuto testuale concatenato di tutte le pagine del PDF.
+        str: Il testo normalizzato.
     """
-    text = ""
-    reader = PyPDF2.PdfReader(stream)
-    for page in reader.pages:
-        # Estrae il testo da ogni pagina e lo aggiunge. Usa 'or ""' per gestire elegantemente le pagine vuote.
-        text += page.extract_text() or ""
-    return text
+    return " ".join(text.split())
 
-def split_text_into_chunks(text: str, max_chunk_size: int = 1000) -> list[str]:
+def iter_chunks(texts: Iterable[str], max_chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP,
+                length_function: Callable[[str], int] = count_tokens) -> Iterator[str]:
     """
-    Suddivide un testo lungo in chunk più piccoli e gestibili.
+    Suddivide un testo lungo, fornito a blocchi (es. una pagina alla volta), in chunk più piccoli e gestibili.
     Questo è un passo critico in RAG per garantire che gli embedding siano focalizzati e il recupero sia preciso.
+    I chunk rispettano i confini di paragrafi, righe e frasi e si sovrappongono di 'chunk_overlap' token,
+    così un concetto a cavallo di due chunk (o di due pagine) non viene spezzato senza contesto.
+    Ogni chunk viene restituito appena è completo: la memoria occupata non dipende dalla lunghezza del documento.
+    
+    Args:
+        texts (Iterable[str]): I blocchi di testo consecutivi del documento.
+        max_chunk_size (int): La lunghezza massima di ogni chunk, in token (o nell'unità di 'length_function').
+        chunk_overlap (int): La lunghezza massima ripresa dalla fine del chunk precedente.
+        length_function (Callable[[str], int]): La funzione che misura la lunghezza di un testo.
+        
+    Yields:
+        str: I chunk di testo, con gli spazi bianchi normalizzati (quelli vuoti vengono scartati).
+    """
+    # Pezzi del chunk corrente con le rispettive lunghezze, misurate una sola volta per pezzo.
+    # La lunghezza di un chunk è approssimata dalla somma di quelle dei pezzi.
+    current, current_len = [], 0
+    for text in texts:
+        # Divide il blocco in pezzi che rispettano la struttura del documento. La riga vuota finale
+        # separa il blocco dal successivo come un paragrafo; la normalizzazione degli spazi bianchi
+        # avviene dopo, altrimenti le righe vuote tra i paragrafi andrebbero perse.
+        for piece in _split_on_separators(text + "\n\n", max_chunk_size, _SEPARATORS, length_function):
+            piece_len = length_function(piece)
+            # Ricompone i pezzi in chunk il più possibile vicini a 'max_chunk_size'.
+            if current and current_len + piece_len > max_chunk_size:
+                chunk = _normalize_whitespace("".join(p for p, _ in current))
+                if chunk:
+                    yield chunk
+                # Mantiene in coda solo i pezzi finali che rientrano nella sovrapposizione (e lasciano spazio al nuovo pezzo).
+                while current and (current_len > chunk_overlap or current_len + piece_len > max_chunk_size):
+                    current_len -= current.pop(0)[1]
+            current.append((piece, piece_len))
+            current_len += piece_len
+    if current:
+        chunk = _normalize_whitespace("".join(p for p, _ in current))
+        if chunk:
+            yield chunk
+
+def split_text_into_chunks(text: str, max_chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP) -> list[str]:
+    """
+    Suddivide un testo già caricato in memoria in chunk (vedi 'iter_chunks').
     
     Args:
         text (str): Il contenuto testuale completo da suddividere.
-        max_chunk_size (int): La lunghezza massima in caratteri per ogni chunk.
+        max_chunk_size (int): La lunghezza massima in token per ogni chunk.
+        chunk_overlap (int): Il numero massimo di token ripresi dalla fine del chunk precedente.
         
     Returns:
         list[str]: Una lista di chunk di testo.
     """
-    print("Suddivisione del testo in chunk...")
-    # Per prima cosa, normalizza gli spazi bianchi per semplificare la suddivisione.
-    text = re.sub(r'\s+', ' ', text).strip()
-    # Suddivide il testo prima per paragrafi, assumendo che siano unità semantiche significative.
-    paragraphs = [p.strip() for p in text.split('\n\n') if p.strip()]
+    return list(iter_chunks([text], max_chunk_size, chunk_overlap))
+
+# --- Deduplicazione dei Chunk Quasi Identici ---
+
+def simhash(text: str) -> int:
+    """
+    Calcola la SimHash a 64 bit di un testo sui trigrammi di parole.
+    Testi quasi identici (es. intestazioni e piè di pagina ripetuti) hanno impronte che differiscono per pochi bit.
+
+    Args:
+        text (str): Il testo del chunk.
+
+    Returns:
+        int: L'impronta a 64 bit.
+    """
+    words = text.lower().split()
+    shingles = [" ".join(words[i:i + 3]) for i in range(max(len(words) - 2, 1))]
+    # Un hash a 64 bit per trigramma; ogni bit dell'impronta è il voto di maggioranza dei bit dei trigrammi.
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big") for shingle in shingles],
+        dtype=">u8"
+    )
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1)
+    votes = 2 * bits.sum(axis=0, dtype=np.int64) - len(shingles)
+    return int.from_bytes(np.packbits(votes > 0).tobytes(), "big")
+
+class NearDuplicateFilter:
+    """
+    Riconosce i chunk quasi identici a uno già visto confrontando le loro SimHash (vedi 'simhash').
+    Per non confrontare ogni impronta con tutte le altre, l'impronta viene divisa in 'max_distance + 1' bande:
+    due impronte a distanza di Hamming <= 'max_distance' hanno almeno una banda identica, quindi basta
+    confrontare le impronte che condividono una banda (Locality-Sensitive Hashing).
+    """
+
+    def __init__(self, max_distance: int = DEDUP_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self.band_bits = 64 // (max_distance + 1)
+        self.buckets = [{} for _ in range(max_distance + 1)]
+
+    def _bands(self, fingerprint: int) -> list[int]:
+        mask = (1 << self.band_bits) - 1
+        return [(fingerprint >> (i * self.band_bits)) & mask for i in range(len(self.buckets))]
+
+    def add(self, fingerprint: int) -> None:
+        """
+        Registra un'impronta senza confrontarla con quelle già viste (es. i chunk già indicizzati dei blob invariati).
+
+        Args:
+            fingerprint (int): La SimHash del chunk.
+        """
+        for bucket, band in zip(self.buckets, self._bands(fingerprint)):
+            bucket.setdefault(band, []).append(fingerprint)
+
+    def is_duplicate(self, fingerprint: int) -> bool:
+        """
+        Controlla se un chunk è quasi identico a uno già visto; in caso contrario lo registra.
+
+        Args:
+            fingerprint (int): La SimHash del chunk.
+
+        Returns:
+            bool: True se il chunk è un quasi duplicato e va scartato.
+        """
+        for bucket, band in zip(self.buckets, self._bands(fingerprint)):
+            for other in bucket.get(band, ()):
+                if (fingerprint ^ other).bit_count() <= self.max_distance:
+                    return True
+        self.add(fingerprint)
+        return False
+
+def chunk_id(blob_name: str, position: int, chunk: str) -> str:
+    """
+    Calcola un ID deterministico per un chunk a partire dal file, dalla posizione e dal contenuto.
+    Lo stesso chunk riceve sempre lo stesso ID, quindi una nuova esecuzione riconosce ciò che è già indicizzato.
+
+    Args:
+        blob_name (str): Il nome del blob da cui proviene il chunk.
+        position (int): La posizione del chunk all'interno del documento.
+        chunk (str): Il testo del chunk.
+
+    Returns:
+        str: Un hash esadecimale di 32 caratteri, valido come chiave di Azure AI Search.
+    """
+    return hashlib.blake2b(f"{blob_name}|{position}|{chunk}".encode("utf-8"), digest_size=16).hexdigest()
+
+def fetch_indexed_ids() -> set[str]:
+    """
+    Legge dall'indice gli ID di tutti i chunk già caricati.
+
+    Returns:
+        set[str]: L'insieme degli ID presenti nell'indice (vuoto se l'indice è vuoto o non raggiungibile).
+    """
+    try:
+        return {result["id"] for result in search_client.search(search_text="*", select=["id"])}
+    except Exception as e:
+        print(f"Attenzione: impossibile leggere gli ID già indicizzati ({e}). Verranno elaborati tutti i chunk.")
+        return set()
+
+def load_checkpoint() -> dict[str, dict]:
+    """
+    Legge dal file di checkpoint lo stato dei blob elaborati nell'ultima esecuzione completata.
+
+    Returns:
+        dict[str, dict]: La mappa nome del blob -> {"etag": ETag, "ids": ID dei chunk indicizzati,
+            "fingerprints": SimHash dei chunk indicizzati} (vuota se il checkpoint è disattivato, assente o illeggibile).
+    """
+    if not BLOB_CHECKPOINT_FILE or not os.path.exists(BLOB_CHECKPOINT_FILE):
+        return {}
+    try:
+        with open(BLOB_CHECKPOINT_FILE, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+        # Le voci nel vecchio formato (solo l'ETag) vengono ignorate: quei blob vengono rielaborati una volta.
+        return {name: entry for name, entry in checkpoint.items() if isinstance(entry, dict)}
+    except (OSError, ValueError) as e:
+        print(f"Attenzione: impossibile leggere il checkpoint '{BLOB_CHECKPOINT_FILE}' ({e}). Verranno elaborati tutti i blob.")
+        return {}
+
+def save_checkpoint(state: dict[str, dict]) -> None:
+    """
+    Salva lo stato dei blob elaborati. Il file viene prima scritto in una copia temporanea e poi
+    sostituito, così un'interruzione durante la scrittura non lascia un checkpoint corrotto.
+
+    Args:
+        state (dict[str, dict]): La mappa nome del blob -> stato (vedi 'load_checkpoint').
+    """
+    temp_file = f"{BLOB_CHECKPOINT_FILE}.tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(temp_file, BLOB_CHECKPOINT_FILE)
+
+def delete_stale_chunks(previous: dict[str, dict], current: dict[str, dict]) -> int:
+    """
+    Elimina dall'indice i chunk che i blob non producono più: quelli della versione precedente di un blob
+    modificato (gli ID dipendono da posizione e testo, quindi cambiano) e tutti quelli dei blob rimossi dal container.
+
+    Args:
+        previous (dict[str, dict]): Lo stato dei blob nel checkpoint dell'esecuzione precedente.
+        current (dict[str, dict]): Lo stato dei blob di questa esecuzione.
+
+    Returns:
+        int: Il numero di chunk eliminati.
+    """
+    stale_ids = []
+    for blob_name, entry in previous.items():
+        current_ids = set(current.get(blob_name, {}).get("ids", ()))
+        stale_ids.extend(doc_id for doc_id in entry.get("ids", ()) if doc_id not in current_ids)
+    for start in range(0, len(stale_ids), UPLOAD_BATCH_SIZE):
+        search_client.delete_documents(documents=[{"id": doc_id} for doc_id in stale_ids[start:start + UPLOAD_BATCH_SIZE]])
+    return len(stale_ids)
+
+def is_supported_blob(blob) -> bool:
+    """
+    Controlla, usando solo i metadati restituiti da 'list_blobs', se un blob va elaborato.
+    Scarta i file con estensione non supportata e quelli vuoti prima di qualsiasi download.
+
+    Args:
+        blob: Le proprietà del blob, come restituite da 'list_blobs'.
+
+    Returns:
+        bool: True se il blob va scaricato ed elaborato.
+    """
+    if not blob.name.lower().endswith(SUPPORTED_EXTENSIONS):
+        print(f"Formato non supportato: {blob.name}. Salto il file.")
+        return False
+    if not blob.size:
+        print(f"Attenzione: il file {blob.name} è vuoto. Salto il file.")
+        return False
+    return True
+
+def load_blob_chunks(container_client, blob_name: str) -> tuple[str, list[str]]:
+    """
+    Scarica un blob, ne estrae il testo in base all'estensione e lo suddivide in chunk.
+    Viene eseguita in parallelo su più blob da un pool di thread.
+
+    Args:
+        container_client: Il client del container di Azure Blob Storage.
+        blob_name (str): Il nome del blob da elaborare.
+
+    Returns:
+        tuple[str, list[str]]: Il nome del blob e la lista dei suoi chunk (vuota se non è stato estratto testo).
+    """
+    print(f"\nElaborazione del file: {blob_name}...")
+    blob_client = container_client.get_blob_client(blob_name)
+    if blob_name.lower().endswith('.pdf'):
+        # Prima del download completo legge solo l'intestazione: un file con estensione .pdf
+        # che non è un PDF valido viene scartato senza trasferirne l'intero contenuto.
+        header = blob_client.download_blob(offset=0, length=PDF_HEADER_BYTES).readall()
+        if PDF_MAGIC not in header:
+            print(f"Attenzione: {blob_name} non è un PDF valido. Salto il file.")
+            return blob_name, []
+    # Scarica il contenuto del file in uno stream di byte in memoria.
+    stream = io.BytesIO(blob_client.download_blob(max_concurrency=BLOB_DOWNLOAD_CONCURRENCY).readall())
     chunks = []
-    for paragraph in paragraphs:
-        # Se un paragrafo è più grande della dimensione massima, lo suddivide ulteriormente.
-        if len(paragraph) > max_chunk_size:
-            for i in range(0, len(paragraph), max_chunk_size):
-                chunks.append(paragraph[i:i + max_chunk_size])
-        else:
-            chunks.append(paragraph)
-    print(f"Testo suddiviso in {len(chunks)} chunk.")
-    return chunks
+
+    # --- Gestione del Tipo di File ---
+    # Elabora i file in base alla loro estensione.
+    if blob_name.lower().endswith('.pdf'):
+        # Le pagine passano direttamente al chunker, senza concatenare il testo dell'intero PDF.
+        chunks = list(iter_chunks(iter_pdf_pages(stream)))
+    elif blob_name.lower().endswith('.txt'):
+        # Per i file di testo, prova a decodificare con UTF-8. Se fallisce, ripiega su
+        # una codifica più permissiva come 'latin-1' per evitare di bloccare lo script.
+        try:
+            document_text = stream.read().decode('utf-8')
+        except UnicodeDecodeError:
+            print(f"  - Attenzione: decodifica UTF-8 fallita per {blob_name}. Riprovo con 'latin-1' e sostituisco gli errori.")
+            stream.seek(0)  # Resetta il puntatore dello stream all'inizio dopo il tentativo di lettura fallito.
+            document_text = stream.read().decode('latin-1', errors='replace')
+        chunks = split_text_into_chunks(document_text)
+
+    # Salta il file se non è stato possibile estrarre alcun testo.
+    if not chunks:
+        print(f"Attenzione: non è stato possibile estrarre testo da {blob_name}. Salto il file.")
+        return blob_name, []
+
+    print(f"Testo di {blob_name} suddiviso in {len(chunks)} chunk.")
+    return blob_name, chunks
+
+def iter_loaded_blobs(executor: ThreadPoolExecutor, container_client, blobs: Iterable, max_pending: int) -> Iterator[tuple[str, list[str]]]:
+    """
+    Elabora i blob sul pool di thread mantenendo al massimo 'max_pending' risultati in anticipo
+    rispetto al consumatore. A differenza di 'executor.map', che accoda subito tutti i blob,
+    la memoria occupata dai chunk in attesa resta limitata anche con container molto grandi.
+
+    Args:
+        executor (ThreadPoolExecutor): Il pool di thread che scarica ed estrae i blob.
+        container_client: Il client del container di Azure Blob Storage.
+        blobs (Iterable): I blob da elaborare, come restituiti da 'list_blobs'.
+        max_pending (int): Il numero massimo di blob inviati al pool ma non ancora consumati.
+
+    Yields:
+        tuple[str, list[str]]: Il nome del blob e i suoi chunk, nell'ordine dei blob.
+    """
+    pending = deque()
+    for blob in blobs:
+        pending.append(executor.submit(load_blob_chunks, container_client, blob.name))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def embed_documents(batch: list[tuple[str, str]]) -> list[dict]:
+    """
+    Genera gli embedding di un blocco di chunk e crea i documenti da caricare su Azure AI Search.
+
+    Args:
+        batch (list[tuple[str, str]]): Le coppie (ID, testo) dei chunk da codificare.
+
+    Returns:
+        list[dict]: I documenti strutturati secondo lo schema dell'indice.
+    """
+    print(f"Generazione degli embedding per {len(batch)} chunk...")
+    # Un'unica chiamata per l'intero blocco: il modello esegue un forward pass per gruppo di
+    # EMBEDDING_BATCH_SIZE testi invece di uno per chunk. 'encode' ordina internamente i testi per
+    # lunghezza (e ripristina l'ordine originale nel risultato), quindi ogni gruppo contiene chunk di
+    # lunghezza simile e il padding resta minimo: più il blocco è grande, più l'ordinamento è efficace.
+    embeddings = embedding_model.encode(
+        [chunk for _, chunk in batch],
+        batch_size=EMBEDDING_BATCH_SIZE,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=True
+    )
+    if VECTOR_PRECISION == "half":
+        embeddings = embeddings.astype(np.float16)
+    # Il client di Azure serializza solo tipi Python nativi: la matrice viene convertita con
+    # un'unica chiamata a 'tolist', che crea tutte le liste in C invece di una chiamata per riga.
+    vectors = embeddings.tolist()
+    # Crea i payload dei documenti strutturati che corrispondono allo schema dell'indice di Azure AI Search.
+    return [
+        {
+            "id": doc_id,               # ID deterministico del chunk.
+            "content": chunk,           # Il contenuto testuale.
+            "content_vector": vector    # L'embedding vettoriale.
+        }
+        for (doc_id, chunk), vector in zip(batch, vectors)
+    ]
 
 # --- Logica Principale ---
 # Questo blocco viene eseguito quando lo script è lanciato direttamente.
 if __name__ == "__main__":
     print(f"Ricerca di documenti nel container '{AZURE_STORAGE_CONTAINER_NAME}'...")
     container_client = blob_service_client.get_container_client(AZURE_STORAGE_CONTAINER_NAME)
-    blob_list = container_client.list_blobs()
-    
-    # Questa lista conterrà tutti i documenti strutturati da caricare in un unico batch.
-    documents_to_upload = []
-
-    # Itera attraverso ogni file (blob) trovato nel container di Azure Blob Storage.
-    for blob in blob_list:
-        print(f"\nElaborazione del file: {blob.name}...")
-        blob_client = container_client.get_blob_client(blob.name)
-        # Scarica il contenuto del file in uno stream di byte in memoria.
-        stream = io.BytesIO(blob_client.download_blob().readall())
-        document_text = ""
-        
-        # --- Gestione del Tipo di File ---
-        # Elabora i file in base alla loro estensione.
-        if blob.name.lower().endswith('.pdf'):
-            document_text = read_text_from_pdf_stream(stream)
-        elif blob.name.lower().endswith('.txt'):
-            # Per i file di testo, prova a decodificare con UTF-8. Se fallisce, ripiega su
-            # una codifica più permissiva come 'latin-1' per evitare di bloccare lo script.
-            try:
-                document_text = stream.read().decode('utf-8')
-            except UnicodeDecodeError:
-                print("  - Attenzione: decodifica UTF-8 fallita. Riprovo con 'latin-1' e sostituisco gli errori.")
-                stream.seek(0)  # Resetta il puntatore dello stream all'inizio dopo il tentativo di lettura fallito.
-                document_text = stream.read().decode('latin-1', errors='replace')
-        
-        # Salta il file se non è stato possibile estrarre alcun testo.
-        if not document_text.strip():
-            print(f"Attenzione: non è stato possibile estrarre testo da {blob.name}. Salto il file.")
-            continue
+    # Filtra i blob sui metadati dell'elenco: quelli non supportati o vuoti non vengono scaricati.
+    blob_list = filter(is_supported_blob, container_client.list_blobs())
 
-        # --- Chunking e Embedding ---
-        chunks = split_text_into_chunks(document_text)
-        
-        print(f"Generazione degli embedding per {len(chunks)} chunk da {blob.name}...")
-        for i, chunk in enumerate(chunks):
-            # Genera l'embedding vettoriale per il chunk di testo corrente.
-            embedding = embedding_model.encode(chunk).tolist()
-
-            # Crea il payload del documento strutturato che corrisponde allo schema dell'indice di Azure AI Search.
-            document = {
-                "id": str(uuid.uuid4()),      # Un ID unico per ogni chunk.
-                "content": chunk,             # Il contenuto testuale.
-                "content_vector": embedding   # L'embedding vettoriale.
-            }
-            documents_to_upload.append(document)
-
-    # --- Caricamento in Batch su Azure AI Search ---
-    # Dopo aver elaborato tutti i file, carica la lista di documenti sull'indice in un unico batch.
-    if documents_to_upload:
-        print(f"\nCaricamento di {len(documents_to_upload)} documenti sull'indice di Azure AI Search...")
+    # Gli ID sono deterministici: i chunk già presenti nell'indice non vengono né ricodificati né ricaricati.
+    indexed_ids = fetch_indexed_ids()
+    print(f"Chunk già presenti nell'indice: {len(indexed_ids)}.")
+
+    # Contatori aggiornati dalle callback del sender (che possono girare anche su un thread di lavoro).
+    upload_stats = {"inviati": 0, "indicizzati": 0, "falliti": 0, "duplicati": 0, "invariati": 0}
+
+    # --- Checkpoint degli ETag ---
+    # L'ETag restituito da 'list_blobs' cambia a ogni modifica del blob: i blob con lo stesso ETag dell'ultima
+    # esecuzione vengono saltati senza scaricarli, quindi una nuova ingestione costa solo quanto i file nuovi o
+    # modificati. Se l'indice è vuoto (es. appena ricreato) il checkpoint viene ignorato e si riparte da zero.
+    checkpoint = load_checkpoint() if indexed_ids else {}
+    # Stato di tutti i blob di questa esecuzione (saltati ed elaborati), salvato nel checkpoint alla fine.
+    current_state = {}
+
+    # I chunk quasi identici (intestazioni, piè di pagina, testo standard ripetuto) vengono scartati
+    # prima dell'embedding: meno calcolo, meno spazio nell'indice e un grafo HNSW più piccolo.
+    duplicate_filter = NearDuplicateFilter() if DEDUP_MAX_DISTANCE >= 0 else None
+
+    def is_changed_blob(blob) -> bool:
+        entry = checkpoint.get(blob.name)
+        # Senza gli ID o le impronte dei chunk (es. checkpoint scritto con la deduplicazione disattivata) il blob non
+        # può alimentare il filtro dei quasi duplicati né la pulizia dei chunk obsoleti: viene rielaborato, e gli ID
+        # deterministici evitano di ricodificarlo.
+        if (entry and entry.get("etag") == blob.etag and "ids" in entry
+                and (duplicate_filter is None or "fingerprints" in entry)):
+            current_state[blob.name] = entry
+            upload_stats["invariati"] += 1
+            return False
+        return True
+
+    # L'elenco (solo metadati) viene letto per intero prima dell'elaborazione, così le impronte dei chunk già
+    # indicizzati dei blob saltati entrano nel filtro prima dei chunk dei blob nuovi o modificati: questi ultimi
+    # vengono deduplicati anche contro il contenuto invariato, come in un'esecuzione completa.
+    blob_list = [blob for blob in blob_list if is_changed_blob(blob)]
+    blob_etags = {blob.name: blob.etag for blob in blob_list}
+    if duplicate_filter:
+        for entry in current_state.values():
+            for fingerprint in entry["fingerprints"]:
+                duplicate_filter.add(fingerprint)
+
+    def on_progress(action):
+        upload_stats["indicizzati"] += 1
+
+    def on_error(action):
+        upload_stats["falliti"] += 1
+        print(f"  - ERRORE: indicizzazione fallita per il documento '{action.get('id')}'.")
+
+    # --- Caricamento Bufferizzato su Azure AI Search ---
+    # Il sender accumula i documenti e li invia a blocchi di UPLOAD_BATCH_SIZE man mano che vengono
+    # prodotti, con retry automatici sui documenti rifiutati per throttling. In memoria resta
+    # solo il blocco corrente invece dell'intero corpus.
+    with SearchIndexingBufferedSender(
+        endpoint=AZURE_SEARCH_ENDPOINT,
+        index_name=AZURE_SEARCH_INDEX_NAME,
+        credential=AzureKeyCredential(AZURE_SEARCH_API_KEY),
+        auto_flush_interval=60,
+        initial_batch_action_count=UPLOAD_BATCH_SIZE,
+        on_progress=on_progress,
+        on_error=on_error
+    ) as sender, ThreadPoolExecutor(max_workers=BLOB_WORKERS) as executor:
+        # --- Pipeline a Fasi Sovrapposte ---
+        # 1. Download, estrazione e chunking sul pool di thread (limitati dalla rete).
+        # 2. Embedding sul thread principale (limitato da CPU/GPU).
+        # 3. Caricamento su un thread dedicato, alimentato da una coda limitata.
+        # Le fasi lavorano in contemporanea, quindi il tempo totale si avvicina a quello della fase più lenta
+        # invece che alla somma delle tre; le code limitate tengono sotto controllo la memoria.
+        upload_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+
+        def upload_worker():
+            while (documents := upload_queue.get()) is not None:
+                try:
+                    sender.upload_documents(documents=documents)
+                except Exception as e:
+                    # Un errore non deve fermare il thread, altrimenti il thread principale resterebbe bloccato sulla coda.
+                    upload_stats["falliti"] += len(documents)
+                    print(f"  - ERRORE durante l'invio di {len(documents)} documenti: {e}")
+
+        uploader = threading.Thread(target=upload_worker, daemon=True)
+        uploader.start()
+
+        pending_chunks = []
         try:
-            result = search_client.upload_documents(documents=documents_to_upload)
-            # L'oggetto result contiene lo stato per ogni documento caricato.
-            print(f"Caricamento completato! {len(result)} documenti indicizzati.")
-        except Exception as e:
-            print(f"ERRORE durante il caricamento su Azure: {e}")
+            for blob_name, chunks in iter_loaded_blobs(executor, container_client, blob_list, BLOB_WORKERS + PIPELINE_QUEUE_SIZE):
+                # Scarta i quasi duplicati e tiene solo i chunk nuovi o modificati rispetto all'ultima esecuzione.
+                # La deduplicazione considera anche i chunk già indicizzati e quelli dei blob saltati (le cui impronte
+                # sono nel filtro), così l'esito non dipende dai blob rielaborati in questa esecuzione.
+                new_chunks = []
+                entry = current_state[blob_name] = {"etag": blob_etags[blob_name], "ids": []}
+                if duplicate_filter:
+                    entry["fingerprints"] = []
+                for position, chunk in enumerate(chunks):
+                    if duplicate_filter:
+                        fingerprint = simhash(chunk)
+                        if duplicate_filter.is_duplicate(fingerprint):
+                            upload_stats["duplicati"] += 1
+                            continue
+                        entry["fingerprints"].append(fingerprint)
+                    doc_id = chunk_id(blob_name, position, chunk)
+                    entry["ids"].append(doc_id)
+                    if doc_id not in indexed_ids:
+                        new_chunks.append((doc_id, chunk))
+                if not new_chunks:
+                    if chunks:
+                        print(f"Nessun chunk nuovo in {blob_name} (già indicizzati o duplicati). Salto il file.")
+                    continue
+
+                # I chunk di più documenti vengono accumulati e codificati in blocchi pieni di UPLOAD_BATCH_SIZE:
+                # anche i file piccoli contribuiscono a batch grandi invece di generare chiamate a 'encode' quasi vuote.
+                print(f"{len(new_chunks)} chunk nuovi da {blob_name} in coda per l'embedding.")
+                pending_chunks.extend(new_chunks)
+                while len(pending_chunks) >= UPLOAD_BATCH_SIZE:
+                    batch, pending_chunks = pending_chunks[:UPLOAD_BATCH_SIZE], pending_chunks[UPLOAD_BATCH_SIZE:]
+                    documents = embed_documents(batch)
+                    upload_queue.put(documents)
+                    upload_stats["inviati"] += len(documents)
+
+            # Codifica gli ultimi chunk rimasti, che non riempiono un blocco intero.
+            if pending_chunks:
+                documents = embed_documents(pending_chunks)
+                upload_queue.put(documents)
+                upload_stats["inviati"] += len(documents)
+        finally:
+            # Segnala la fine dei documenti e attende che il thread di caricamento abbia svuotato la coda.
+            upload_queue.put(None)
+            uploader.join()
+        # All'uscita dal blocco 'with' il sender invia gli ultimi documenti rimasti nel buffer.
+
+    # --- Riepilogo del Caricamento ---
+    if upload_stats["invariati"]:
+        print(f"Blob invariati dall'ultima esecuzione (saltati): {upload_stats['invariati']}.")
+    if upload_stats["duplicati"]:
+        print(f"Chunk quasi duplicati scartati: {upload_stats['duplicati']}.")
+    if upload_stats["inviati"]:
+        print(f"\nCaricamento completato! {upload_stats['indicizzati']}/{upload_stats['inviati']} documenti indicizzati ({upload_stats['falliti']} falliti).")
     else:
-        print("Attenzione: nessun documento da caricare è stato trovato.")
\ No newline at end of file
+        print("Attenzione: nessun documento da caricare è stato trovato.")
+
+    # Il checkpoint viene aggiornato solo se tutti i documenti sono stati indicizzati: in caso contrario la
+    # prossima esecuzione riscarica i blob, e gli ID deterministici evitano di ricodificare i chunk già presenti.
+    # Prima vengono eliminati i chunk obsoleti dei blob modificati o rimossi (solo dopo che la nuova versione è
+    # stata indicizzata); se l'eliminazione fallisce il checkpoint resta quello precedente e la prossima
+    # esecuzione la ripete.
+    if BLOB_CHECKPOINT_FILE:
+        if upload_stats["falliti"]:
+            print("Attenzione: alcuni documenti non sono stati indicizzati. Il checkpoint dei blob non viene aggiornato.")
+        else:
+            try:
+                deleted = delete_stale_chunks(checkpoint, current_state)
+                if deleted:
+                    print(f"Chunk obsoleti di blob modificati o rimossi eliminati dall'indice: {deleted}.")
+                save_checkpoint(current_state)
+            except Exception as e:
+                print(f"Attenzione: eliminazione dei chunk obsoleti fallita ({e}). Il checkpoint dei blob non viene aggiornato.")
@@ -7,124 +7,292 @@
 # calcolo del punteggio medio finale per una metrica di performance più accurata.
 
 import os
+import re
 import sys
 import json
+import hashlib
+import importlib
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
 from dotenv import load_dotenv
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
+import numpy as np
 
 # Aggiunge la directory principale del progetto al path di Python per consentire l'importazione di moduli locali.
 script_directory = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(script_directory)
 
-# Importa i moduli personalizzati del progetto.
-from index import product
-from writer import writer_ollama, writer_azure_openai
-from query_rewriter import rewrite_query
+# Importa i moduli personalizzati del progetto. 'index' (che carica il modello di embedding e il client
+# di ricerca) e gli scrittori LLM vengono importati solo quando servono, nel blocco principale.
+from query_rewriter import rewrite_query, rewrite_queries_bulk
+
+# Carica le variabili d'ambiente (chiavi API, endpoint, impostazioni) dal file .env.
+load_dotenv()
 
 # --- Configurazione del Modello ---
 # Questa variabile permette di passare da un LLM all'altro per la valutazione.
-# Deve corrispondere alle chiavi usate nel dizionario 'writers' (es. "azure", "ollama").
+# Deve corrispondere alle chiavi del dizionario 'MODULI_WRITER' (es. "azure", "ollama").
 MODELLO_DA_USARE = "azure"  # Opzioni: "azure", "ollama"
 
-def salva_report_excel(risultati, punteggio_medio_totale, risultati_cat, num_validi, num_totali):
+# Frase con cui il modello segnala di non aver trovato contesto sufficiente: le risposte che la contengono
+# vengono escluse dalla media. L'espressione precompilata ignora le maiuscole senza creare una copia minuscola del testo.
+CONTESTO_INSUFFICIENTE_RE = re.compile(r"contesto non sufficiente", re.IGNORECASE)
+
+# Registro su cui ogni risultato viene aggiunto appena pronto: se l'esecuzione si interrompe (es. un errore del
+# backend LLM a metà valutazione), la successiva riparte dalle domande mancanti invece di ricominciare da capo.
+# Il file viene eliminato quando il report finale è stato salvato.
+FILE_RISULTATI_PARZIALI = os.path.join(script_directory, f"risultati_parziali_{MODELLO_DA_USARE}.jsonl")
+
+# Modulo scrittore per ciascun LLM. Viene importato solo quello selezionato, così l'SDK
+# e la configurazione dell'altro non vengono caricati.
+MODULI_WRITER = {
+    "ollama": "writer.writer_ollama",
+    "azure": "writer.writer_azure_openai"
+}
+
+# Numero di domande elaborate in parallelo. Riscrittura, ricerca e generazione sono chiamate di rete:
+# mentre un thread attende una risposta, gli altri possono procedere.
+EVAL_WORKERS = int(os.getenv("EVAL_WORKERS", "4"))
+
+# File in cui vengono conservati tra un'esecuzione e l'altra gli embedding delle risposte ideali,
+# che cambiano solo se cambia il golden dataset o il modello. Una stringa vuota disattiva la cache.
+EVAL_EMBEDDING_CACHE = os.getenv("EVAL_EMBEDDING_CACHE", os.path.join(script_directory, "embedding_cache_ideali.npz"))
+
+# File (facoltativo) in cui conservare le risposte della pipeline RAG per ogni modello e domanda: con la cache
+# attiva, una nuova esecuzione (es. dopo aver cambiato solo il calcolo dei punteggi o il report) non ripete le
+# chiamate agli LLM per le domande già elaborate. Vuota (predefinito) disattiva la cache tra un'esecuzione e l'altra.
+EVAL_RAG_CACHE = os.getenv("EVAL_RAG_CACHE", "")
+
+# Domande riformulate insieme con una sola richiesta all'LLM prima del ciclo di valutazione, invece di una
+# richiesta per domanda. 0 disattiva la riscrittura in blocco (ogni pipeline riscrive la propria domanda).
+EVAL_REWRITE_BATCH_SIZE = int(os.getenv("EVAL_REWRITE_BATCH_SIZE", "10"))
+
+# --- Stili del Report Excel ---
+# Creati una sola volta a livello di modulo e condivisi da tutte le celle del report.
+HEADER_FONT = Font(bold=True, color="FFFFFF")
+HEADER_FILL = PatternFill(start_color="4F81BD", end_color="4F81BD", fill_type="solid")
+HEADER_ALIGNMENT = Alignment(horizontal="center", vertical="center", wrap_text=True)
+# Stile per le righe escluse dal calcolo del punteggio medio.
+EXCLUDED_FILL = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")
+# Bordi e a capo automatico per tutte le celle di dati, per una migliore leggibilità.
+DATA_ALIGNMENT = Alignment(wrap_text=True, vertical="top")
+THIN_BORDER = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+# Stili della sezione di riepilogo.
+TITLE_FONT = Font(bold=True, size=14)
+SUBTITLE_FONT = Font(bold=True, size=12)
+BOLD_FONT = Font(bold=True)
+SCORE_FONT = Font(bold=True, color="00B050")
+
+def salva_report_excel(risultati, punteggio_medio_totale, risultati_cat, num_validi, num_totali) -> str | None:
     """
     Salva i risultati della valutazione in un file Excel ben formattato.
     Questa funzione gestisce tutta la formattazione e l'aggregazione dei dati per il report finale.
+
+    Returns:
+        str | None: Il nome del file salvato, oppure None se il salvataggio non è riuscito.
     """
     # Mantiene l'output della console in italiano.
     print("\nSalvataggio del report su file Excel...")
     try:
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "RAG Evaluation Report"
+        # Modalità write-only: le righe vengono scritte in streaming sul file invece di restare in memoria
+        # come oggetti Cell, e ogni cella riceve il proprio stile una sola volta, nel momento in cui viene scritta.
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("RAG Evaluation Report")
+
+        def cella(value, **stile):
+            """Crea una cella per il foglio write-only con gli stili indicati (font, fill, alignment, border)."""
+            c = WriteOnlyCell(ws, value=value)
+            for attributo, valore in stile.items():
+                setattr(c, attributo, valore)
+            return c
+
+        # Imposta la larghezza delle colonne per un layout migliore (in write-only va fatto prima di scrivere le righe).
+        ws.column_dimensions['A'].width = 20
+        ws.column_dimensions['B'].width = 50
+        ws.column_dimensions['C'].width = 50
+        ws.column_dimensions['D'].width = 60
+        ws.column_dimensions['E'].width = 60
+        ws.column_dimensions['F'].width = 20
+
+        # --- Formattazione Excel ---
+        # Gli stili sono le costanti di modulo: le righe di dati condividono anche gli stessi due insiemi di stili.
+        data_style = {"alignment": DATA_ALIGNMENT, "border": THIN_BORDER}
+        excluded_style = {**data_style, "fill": EXCLUDED_FILL}
 
         # Definisce le intestazioni per il report Excel, inclusa la nuova colonna "Domanda Riformulata".
         headers = ["Categoria", "Domanda Originale", "Domanda Riformulata", "Risposta Ideale", "Risposta Generata", "Punteggio Similarità"]
-        ws.append(headers)
-        
-        # --- Formattazione Excel ---
-        header_font = Font(bold=True, color="FFFFFF")
-        header_fill = PatternFill(start_color="4F81BD", end_color="4F81BD", fill_type="solid")
-        # Stile per le righe escluse dal calcolo del punteggio medio.
-        excluded_fill = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")
-        
-        for cell in ws[1]:
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
+        ws.append([cella(h, font=HEADER_FONT, fill=HEADER_FILL, alignment=HEADER_ALIGNMENT) for h in headers])
 
         # --- Popolamento dei Dati ---
         for item in risultati:
-            ws.append([
+            valori = [
                 item["categoria"],
                 item["domanda"],
                 item["domanda_riformulata"],
                 item["risposta_ideale"],
                 item["risposta_generata"],
                 f'{item["score"]:.4f}'
-            ])
-            # Evidenzia le righe in cui il modello non ha trovato contesto sufficiente.
-            if "contesto non sufficiente" in item["risposta_generata"].lower():
-                for cell in ws[ws.max_row]:
-                    cell.fill = excluded_fill
-
-        # Applica bordi e a capo automatico a tutte le celle di dati per una migliore leggibilità.
-        thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-        for row in ws.iter_rows(min_row=2, max_row=len(risultati)+1):
-            for cell in row:
-                cell.alignment = Alignment(wrap_text=True, vertical="top")
-                cell.border = thin_border
-        
-        # Imposta la larghezza delle colonne per un layout migliore.
-        ws.column_dimensions['A'].width = 20
-        ws.column_dimensions['B'].width = 50
-        ws.column_dimensions['C'].width = 50
-        ws.column_dimensions['D'].width = 60
-        ws.column_dimensions['E'].width = 60
-        ws.column_dimensions['F'].width = 20
-        
+            ]
+            # Evidenzia le righe escluse dalla media (contesto insufficiente o errore), già marcate durante la valutazione.
+            stile = excluded_style if item["escluso"] else data_style
+            ws.append([cella(valore, **stile) for valore in valori])
+
         # --- Sezione di Riepilogo ---
-        # Aggiunge un blocco di riepilogo alla fine del report con le metriche complessive.
+        # Aggiunge un blocco di riepilogo alla fine del report con le metriche complessive, dopo due righe vuote.
         start_row = len(risultati) + 4
-        ws.cell(row=start_row, column=1, value="Evaluation Summary").font = Font(bold=True, size=14)
-        ws.merge_cells(start_row=start_row, start_column=1, end_row=start_row, end_column=3)
-        
-        ws.cell(row=start_row + 1, column=1, value="Model Used:").font = Font(bold=True)
-        ws.cell(row=start_row + 1, column=2, value=MODELLO_DA_USARE.upper())
-        ws.cell(row=start_row + 2, column=1, value="Evaluated Samples:").font = Font(bold=True)
-        ws.cell(row=start_row + 2, column=2, value=f"{num_validi} / {num_totali}")
-        ws.cell(row=start_row + 3, column=1, value="Overall Average Score:").font = Font(bold=True)
-        ws.cell(row=start_row + 3, column=2, value=f"{punteggio_medio_totale:.4f}").font = Font(bold=True, color="00B050")
-        
-        ws.cell(row=start_row + 5, column=1, value="Average Scores by Category").font = Font(bold=True, size=12)
-        ws.merge_cells(start_row=start_row+5, start_column=1, end_row=start_row+5, end_column=3)
-        cat_row = start_row + 6
+        ws.append([])
+        ws.append([])
+        ws.append([cella("Evaluation Summary", font=TITLE_FONT)])
+        ws.merged_cells.add(f"A{start_row}:C{start_row}")
+
+        ws.append([cella("Model Used:", font=BOLD_FONT), MODELLO_DA_USARE.upper()])
+        ws.append([cella("Evaluated Samples:", font=BOLD_FONT), f"{num_validi} / {num_totali}"])
+        ws.append([cella("Overall Average Score:", font=BOLD_FONT), cella(f"{punteggio_medio_totale:.4f}", font=SCORE_FONT)])
+        ws.append([])
+
+        ws.append([cella("Average Scores by Category", font=SUBTITLE_FONT)])
+        ws.merged_cells.add(f"A{start_row + 5}:C{start_row + 5}")
         for categoria, punteggio in risultati_cat.items():
-            ws.cell(row=cat_row, column=1, value=f"Category '{categoria}'")
-            ws.cell(row=cat_row, column=2, value=f"{punteggio['media']:.4f} ({punteggio['validi']}/{punteggio['totali']} samples)").font = Font(bold=True)
-            cat_row += 1
+            ws.append([
+                f"Category '{categoria}'",
+                cella(f"{punteggio['media']:.4f} ({punteggio['validi']}/{punteggio['totali']} samples)", font=BOLD_FONT)
+            ])
 
         # Genera un nome file unico con un timestamp.
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         file_name = f'report_valutazione_{MODELLO_DA_USARE}_{timestamp}.xlsx'
         wb.save(file_name)
         print(f"✅ Report salvato con successo come '{file_name}'")
+        return file_name
         
     except Exception as e:
         print(f"ERRORE durante il salvataggio del report Excel: {e}")
+        return None
+
+
+def codifica_con_cache(testi: list[str], model, namespace: str) -> dict[str, np.ndarray]:
+    """
+    Restituisce gli embedding normalizzati dei testi, leggendo dalla cache su disco quelli già calcolati
+    e codificando tutti gli altri con un'unica chiamata batch. La cache viene poi aggiornata.
+
+    Args:
+        testi (list[str]): I testi da codificare (senza duplicati).
+        model: Il modello di embedding usato per i testi non presenti in cache.
+        namespace (str): Identifica la configurazione del modello: cambiandola, gli embedding salvati non vengono riutilizzati.
+
+    Returns:
+        dict[str, np.ndarray]: La mappa testo -> embedding.
+    """
+    # La chiave include la configurazione del modello, così un cambio di modello invalida la cache.
+    chiavi = {testo: hashlib.sha256(f"{namespace}|{testo}".encode("utf-8")).hexdigest() for testo in testi}
+    cache = {}
+    if EVAL_EMBEDDING_CACHE and os.path.exists(EVAL_EMBEDDING_CACHE):
+        try:
+            with np.load(EVAL_EMBEDDING_CACHE) as archivio:
+                cache = {chiave: archivio[chiave].astype(np.float32, copy=False) for chiave in archivio.files}
+        except (OSError, ValueError) as e:
+            print(f"Attenzione: impossibile leggere la cache degli embedding ({e}). Verranno ricalcolati.")
+
+    mancanti = [testo for testo in testi if chiavi[testo] not in cache]
+    print(f"Embedding in cache: {len(testi) - len(mancanti)}/{len(testi)}.")
+    if mancanti:
+        # Con la precisione fp16 (predefinita su GPU CUDA) 'encode' restituisce vettori float16: vengono convertiti
+        # in float32, così la cache e i prodotti scalari dei punteggi non dipendono dalla precisione del modello.
+        embedding_mancanti = model.encode(mancanti, batch_size=64, normalize_embeddings=True).astype(np.float32, copy=False)
+        for testo, embedding in zip(mancanti, embedding_mancanti):
+            cache[chiavi[testo]] = embedding
+        if EVAL_EMBEDDING_CACHE:
+            # Scrive prima in un file temporaneo: un'interruzione non lascia una cache corrotta.
+            file_temporaneo = f"{EVAL_EMBEDDING_CACHE}.tmp"
+            with open(file_temporaneo, "wb") as f:
+                np.savez(f, **cache)
+            os.replace(file_temporaneo, EVAL_EMBEDDING_CACHE)
+
+    return {testo: cache[chiavi[testo]] for testo in testi}
+
+
+def carica_cache_rag() -> dict:
+    """
+    Legge dal file EVAL_RAG_CACHE le risposte RAG salvate nelle esecuzioni precedenti.
 
+    Returns:
+        dict: La mappa modello -> {domanda: [risposta generata, query riscritta]} (vuota se la cache è disattivata o assente).
+    """
+    if not EVAL_RAG_CACHE or not os.path.exists(EVAL_RAG_CACHE):
+        return {}
+    try:
+        with open(EVAL_RAG_CACHE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Attenzione: impossibile leggere la cache RAG '{EVAL_RAG_CACHE}' ({e}). Tutte le domande verranno rielaborate.")
+        return {}
+
+
+def carica_risultati_parziali() -> dict[str, tuple[str, str]]:
+    """
+    Legge il registro FILE_RISULTATI_PARZIALI lasciato da un'esecuzione interrotta.
+
+    Returns:
+        dict[str, tuple[str, str]]: La mappa domanda -> (risposta generata, query riscritta) delle pipeline
+            completate senza errori (vuota se non c'è un'esecuzione da riprendere).
+    """
+    risultati = {}
+    if not os.path.exists(FILE_RISULTATI_PARZIALI):
+        return risultati
+    with open(FILE_RISULTATI_PARZIALI, 'r', encoding='utf-8') as f:
+        for riga in f:
+            try:
+                record = json.loads(riga)
+            except ValueError:
+                # L'ultima riga può essere incompleta se l'interruzione è avvenuta durante la scrittura.
+                continue
+            # Le pipeline fallite vengono ritentate. Oltre a quelle marcate come errore, anche le righe con il
+            # messaggio di errore dello scrittore: i registri delle versioni precedenti le marcano come riuscite.
+            if not record.get("errore") and record["risposta_generata"] != messaggio_errore_writer(MODELLO_DA_USARE):
+                risultati[record["domanda"]] = (record["risposta_generata"], record["domanda_riformulata"])
+    return risultati
+
+
+@lru_cache(maxsize=None)
+def carica_writer(nome_modello: str):
+    """
+    Importa (una sola volta) il modulo scrittore dell'LLM indicato e ne restituisce la funzione 'write'.
+
+    Args:
+        nome_modello (str): La chiave dell'LLM in 'MODULI_WRITER' (es. "azure" o "ollama").
 
-def esegui_rag(domanda: str) -> tuple[str, str]:
+    Returns:
+        Callable[..., str]: La funzione che genera la risposta dato il contesto e la domanda.
+    """
+    return importlib.import_module(MODULI_WRITER[nome_modello]).write
+
+
+def messaggio_errore_writer(nome_modello: str) -> str:
+    """
+    Restituisce il testo che lo scrittore dell'LLM indicato produce al posto della risposta quando la generazione
+    fallisce: gli scrittori non sollevano eccezioni, quindi un errore va riconosciuto da questo messaggio.
+
+    Args:
+        nome_modello (str): La chiave dell'LLM in 'MODULI_WRITER' (es. "azure" o "ollama").
+
+    Returns:
+        str: Il messaggio di errore dello scrittore.
+    """
+    return importlib.import_module(MODULI_WRITER[nome_modello]).ERROR_MESSAGE
+
+
+def esegui_rag(domanda: str, query_per_ricerca: str | None = None) -> tuple[str, str]:
     """
     Orchestra l'intera pipeline RAG per una singola domanda.
     Questa versione include il passo di riscrittura della query per migliorare il recupero.
 
     Args:
         domanda (str): La domanda originale dell'utente dal golden dataset.
+        query_per_ricerca (str | None): La query già riscritta (es. in blocco con 'rewrite_queries_bulk').
+            Se None, la domanda viene riscritta qui.
 
     Returns:
         tuple[str, str]: Una tupla contenente la risposta generata e la query riscritta.
@@ -132,34 +300,55 @@ def esegui_rag(domanda: str) -> tuple[str, str]:
     print(f"  - Esecuzione RAG per la domanda: '{domanda}'")
     
     # 1. Riscrittura della Query: Migliora la domanda originale per una ricerca semantica più efficace.
-    query_per_ricerca = rewrite_query(domanda, MODELLO_DA_USARE)
+    if query_per_ricerca is None:
+        query_per_ricerca = rewrite_query(domanda, MODELLO_DA_USARE)
     
     # 2. Recupero: Usa la query riscritta per trovare documenti pertinenti dall'indice di ricerca.
     documenti_trovati = product.find_products(context=query_per_ricerca)
     
     # 3. Aumento: Prepara il contesto recuperato per essere iniettato nel prompt finale.
-    contesto_per_prompt = "\n\n---\n\n".join([doc.get("content", "") for doc in documenti_trovati]) if documenti_trovati else "Nessun contesto specifico è stato trovato."
+    contesto_per_prompt = "\n\n---\n\n".join(documenti_trovati) if documenti_trovati else "Nessun contesto specifico è stato trovato."
     
     # 4. Generazione: Seleziona lo scrittore LLM appropriato e genera la risposta finale.
-    writers = {
-        "ollama": writer_ollama.write,
-        "azure": writer_azure_openai.write # Usa "azure" come chiave
-    }
-    
     # Il prompt finale usa il contesto recuperato ma la domanda ORIGINALE per garantire
     # che la risposta sia direttamente indirizzata alla richiesta iniziale dell'utente.
-    risposta_generata = writers[MODELLO_DA_USARE](productContext=contesto_per_prompt, assignment=domanda)
+    risposta_generata = carica_writer(MODELLO_DA_USARE)(productContext=contesto_per_prompt, assignment=domanda)
+    # Una generazione fallita diventa un'eccezione: la pipeline risulta in errore, quindi la risposta non entra
+    # nella cache RAG e non riceve un punteggio come se fosse una risposta reale.
+    if risposta_generata == messaggio_errore_writer(MODELLO_DA_USARE):
+        raise RuntimeError(f"generazione fallita ('{risposta_generata}')")
     
     # Restituisce sia la risposta finale sia la query riscritta per un report dettagliato.
     return risposta_generata, query_per_ricerca
 
 
+def esegui_rag_protetto(domanda: str, query_per_ricerca: str | None = None) -> tuple[str, str] | Exception:
+    """
+    Esegue 'esegui_rag' su un thread del pool, restituendo l'eventuale eccezione invece di sollevarla,
+    così un errore su una domanda non interrompe la valutazione delle altre.
+
+    Args:
+        domanda (str): La domanda originale dell'utente dal golden dataset.
+        query_per_ricerca (str | None): La query già riscritta, oppure None per riscriverla nella pipeline.
+
+    Returns:
+        tuple[str, str] | Exception: La risposta generata e la query riscritta, oppure l'errore verificatosi.
+    """
+    try:
+        return esegui_rag(domanda, query_per_ricerca)
+    except Exception as e:
+        return e
+
+
 # --- Flusso Principale di Valutazione ---
 if __name__ == "__main__":
     print(f"--- INIZIO VALUTAZIONE (MODELLO SELEZIONATO: {MODELLO_DA_USARE.upper()}) ---")
-    
-    # Carica le variabili d'ambiente (chiavi API, endpoint) dal file .env.
-    load_dotenv()
+
+    # Il modulo di recupero carica il modello di embedding e il client di ricerca: lo importa solo ora
+    # che la valutazione viene effettivamente eseguita. Anche lo scrittore viene importato subito, una volta
+    # sola, prima che i thread del pool lo richiedano.
+    from index import product, get_embedding_model, codifica_query
+    carica_writer(MODELLO_DA_USARE)
     
     print("Caricamento di golden_dataset.json...")
     try:
@@ -171,95 +360,180 @@ if __name__ == "__main__":
         print(f"ERRORE: File '{dataset_path}' non trovato.")
         sys.exit()
 
-    # Carica il modello sentence-transformer usato per calcolare i punteggi di similarità del coseno.
-    # Questo modello deve essere consistente per produrre punteggi comparabili.
-    print("Caricamento del modello di embedding per il calcolo dei punteggi...")
-    model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
-    print("Modello di embedding caricato.")
+    # Il modello sentence-transformer usato per calcolare i punteggi di similarità del coseno è lo stesso
+    # già caricato da index.py per il recupero (configurato in embedding.py, con GPU e fp16 se disponibili):
+    # non serve caricarne una seconda copia. Deve restare consistente per produrre punteggi comparabili.
+    model = get_embedding_model()
+
+    # Le risposte ideali sono note prima del ciclo: vengono codificate tutte insieme con un'unica chiamata
+    # batch, una sola volta per testo distinto, invece di ricalcolarle a ogni elemento del dataset.
+    # Restano salvate su disco, quindi le esecuzioni successive codificano solo le risposte nuove o modificate.
+    print("Calcolo degli embedding delle risposte ideali...")
+    # Gli embedding salvati vengono riutilizzati solo con la stessa configurazione effettiva del modello
+    # (file esportato, server, precisione e dispositivo compresi): vedi 'embedding_signature'.
+    from embedding import embedding_signature
+    namespace_embedding = embedding_signature(model)
+    risposte_ideali_distinte = list(dict.fromkeys(item["risposta_ideale"] for item in golden_dataset))
+    embedding_ideali = codifica_con_cache(risposte_ideali_distinte, model, namespace_embedding)
 
     # Inizializza le liste per memorizzare i risultati per l'aggregazione finale e l'esportazione.
     risultati_per_export = []
-    risultati_valutazione_validi = []
-    risultati_per_categoria_validi = {}
+    # Posizioni (in 'risultati_per_export') delle risposte valide, da confrontare con quelle ideali.
+    indici_validi = []
+
+    # La pipeline RAG viene eseguita una sola volta per domanda distinta: le domande ripetute nel dataset
+    # e quelle già presenti nella cache RAG (se attiva) riusano la risposta invece di richiamare gli LLM.
+    cache_rag = carica_cache_rag()
+    # Le risposte di errore dello scrittore salvate da versioni precedenti non vengono riutilizzate.
+    risposte_in_cache = {domanda: tuple(esito) for domanda, esito in cache_rag.get(MODELLO_DA_USARE, {}).items()
+                         if esito[0] != messaggio_errore_writer(MODELLO_DA_USARE)}
+    # Riprende un'eventuale esecuzione interrotta: le domande già completate non vengono rielaborate.
+    risultati_ripresi = carica_risultati_parziali()
+    if risultati_ripresi:
+        print(f"Ripresa di un'esecuzione interrotta: {len(risultati_ripresi)} risposte già presenti in '{FILE_RISULTATI_PARZIALI}'.")
+        risposte_in_cache.update(risultati_ripresi)
+    domande_distinte = list(dict.fromkeys(item["domanda"] for item in golden_dataset))
+    domande_da_eseguire = [domanda for domanda in domande_distinte if domanda not in risposte_in_cache]
+    print(f"Domande distinte: {len(domande_distinte)} ({len(domande_distinte) - len(domande_da_eseguire)} già nella cache RAG).")
 
     print("\nInizio del ciclo di valutazione sul Golden Dataset...")
-    # Itera su ogni coppia domanda-risposta nel golden dataset.
-    for i, item in enumerate(golden_dataset):
-        categoria = item['categoria']
-        domanda_test = item["domanda"]
-        risposta_ideale = item["risposta_ideale"]
+    # Le pipeline RAG delle diverse domande girano in parallelo sul pool di thread; il ciclo attende i
+    # risultati nell'ordine del dataset, quindi punteggi, stampe e report restano nello stesso ordine.
+    with ThreadPoolExecutor(max_workers=EVAL_WORKERS) as executor, open(FILE_RISULTATI_PARZIALI, 'a', encoding='utf-8') as registro:
+        # Le domande vengono prima riformulate a blocchi di EVAL_REWRITE_BATCH_SIZE, una richiesta all'LLM per
+        # blocco (i blocchi in parallelo sul pool), e le query riscritte passano direttamente alle pipeline.
+        riscritture = {}
+        if EVAL_REWRITE_BATCH_SIZE > 0 and domande_da_eseguire:
+            print("Riformulazione delle domande in blocco...")
+            blocchi = [domande_da_eseguire[k:k + EVAL_REWRITE_BATCH_SIZE] for k in range(0, len(domande_da_eseguire), EVAL_REWRITE_BATCH_SIZE)]
+            for blocco, riscritte in zip(blocchi, executor.map(rewrite_queries_bulk, blocchi, [MODELLO_DA_USARE] * len(blocchi))):
+                riscritture.update(zip(blocco, riscritte))
+            # Le query riformulate vengono codificate tutte insieme, con un solo passaggio del modello di embedding:
+            # le ricerche delle pipeline trovano poi il vettore già pronto.
+            codifica_query(list(riscritture.values()))
+
+        esiti_futuri = {domanda: executor.submit(esegui_rag_protetto, domanda, riscritture.get(domanda)) for domanda in domande_da_eseguire}
+        esiti_rag = (
+            risposte_in_cache[item["domanda"]] if item["domanda"] in risposte_in_cache else esiti_futuri[item["domanda"]].result()
+            for item in golden_dataset
+        )
 
-        print(f"\n--- Valutazione elemento {i+1}/{len(golden_dataset)} (Categoria: {categoria}) ---")
+        # Itera su ogni coppia domanda-risposta nel golden dataset.
+        for i, (item, esito) in enumerate(zip(golden_dataset, esiti_rag)):
+            categoria = item['categoria']
+            domanda_test = item["domanda"]
+            risposta_ideale = item["risposta_ideale"]
+
+            print(f"\n--- Valutazione elemento {i+1}/{len(golden_dataset)} (Categoria: {categoria}) ---")
         
-        # Inizializza le variabili prima del blocco try per prevenire NameError in caso di eccezioni.
-        risposta_generata = "ERRORE SCONOSCIUTO"
-        domanda_riformulata = "ERRORE SCONOSCIUTO"
+            # Inizializza le variabili prima del blocco try per prevenire NameError in caso di eccezioni.
+            risposta_generata = "ERRORE SCONOSCIUTO"
+            domanda_riformulata = "ERRORE SCONOSCIUTO"
 
-        try:
-            # Esegue la pipeline RAG e cattura sia la risposta sia la query riscritta.
-            risposta_generata, domanda_riformulata = esegui_rag(domanda_test)
-            is_contesto_insufficiente = "contesto non sufficiente" in risposta_generata.lower()
-
-            if is_contesto_insufficiente:
-                # Se il modello segnala che il contesto era insufficiente, assegna un punteggio di 0.
-                # Questa risposta sarà esclusa dal calcolo del punteggio medio finale.
-                print("  - Rilevata risposta 'Contesto non sufficiente'. Esclusa dal calcolo della media.")
+            try:
+                # Recupera l'esito della pipeline RAG: sia la risposta sia la query riscritta.
+                if isinstance(esito, Exception):
+                    raise esito
+                risposta_generata, domanda_riformulata = esito
+                is_contesto_insufficiente = CONTESTO_INSUFFICIENTE_RE.search(risposta_generata) is not None
+
+                if is_contesto_insufficiente:
+                    # Se il modello segnala che il contesto era insufficiente, assegna un punteggio di 0.
+                    # Questa risposta sarà esclusa dal calcolo del punteggio medio finale.
+                    print("  - Rilevata risposta 'Contesto non sufficiente'. Esclusa dal calcolo della media.")
+                # Il punteggio delle risposte valide viene calcolato dopo il ciclo, per tutte insieme.
                 score = 0.0
-            else:
-                # Se viene generata una risposta valida, calcola la sua similarità semantica con la risposta ideale.
-                embedding_generato = model.encode([risposta_generata])
-                embedding_ideale = model.encode([risposta_ideale])
-                score = cosine_similarity(embedding_generato, embedding_ideale)[0][0]
             
-            # Stampa un confronto sulla console per il monitoraggio in tempo reale.
-            print("\n" + "="*20 + " CONFRONTO RISPOSTE " + "="*20)
-            print(f"DOMANDA           : {domanda_test}")
-            print(f"QUERY RISCRITTA   : {domanda_riformulata}") # Aggiunto per visibilità
-            print(f"RISPOSTA IDEALE   :\n{risposta_ideale}\n")
-            print(f"RISPOSTA GENERATA :\n{risposta_generata.strip()}")
-            print("="*62 + "\n")
-            print(f"  - Punteggio Similarità Semantica: {score:.4f}")
+                # Stampa un confronto sulla console per il monitoraggio in tempo reale.
+                print("\n" + "="*20 + " CONFRONTO RISPOSTE " + "="*20)
+                print(f"DOMANDA           : {domanda_test}")
+                print(f"QUERY RISCRITTA   : {domanda_riformulata}") # Aggiunto per visibilità
+                print(f"RISPOSTA IDEALE   :\n{risposta_ideale}\n")
+                print(f"RISPOSTA GENERATA :\n{risposta_generata.strip()}")
+                print("="*62 + "\n")
             
-        except Exception as e:
-            # Cattura eventuali errori inaspettati durante l'esecuzione della pipeline RAG.
-            print(f"\nSi è verificato un errore inaspettato: {e}\n")
-            score = 0.0
-            # Assicura che le variabili abbiano valori di errore se il blocco try fallisce.
-            risposta_generata = f"ERRORE: {e}"
-            is_contesto_insufficiente = True
-
-        # Memorizza i risultati dell'elemento corrente per la successiva esportazione.
-        risultati_per_export.append({
-            "categoria": categoria,
-            "domanda": domanda_test,
-            "domanda_riformulata": domanda_riformulata,
-            "risposta_ideale": risposta_ideale,
-            "risposta_generata": risposta_generata.strip(),
-            "score": score
-        })
+            except Exception as e:
+                # Cattura eventuali errori inaspettati durante l'esecuzione della pipeline RAG.
+                print(f"\nSi è verificato un errore inaspettato: {e}\n")
+                score = 0.0
+                # Assicura che le variabili abbiano valori di errore se il blocco try fallisce.
+                risposta_generata = f"ERRORE: {e}"
+                is_contesto_insufficiente = True
+
+            # Memorizza i risultati dell'elemento corrente per la successiva esportazione.
+            risultati_per_export.append({
+                "categoria": categoria,
+                "domanda": domanda_test,
+                "domanda_riformulata": domanda_riformulata,
+                "risposta_ideale": risposta_ideale,
+                "risposta_generata": risposta_generata.strip(),
+                "score": score,
+                "escluso": is_contesto_insufficiente
+            })
+            # Aggiunge subito il risultato al registro e lo forza su disco, così resta disponibile anche se
+            # l'esecuzione si interrompe prima del report. Le pipeline fallite (comprese le generazioni fallite dello
+            # scrittore, che 'esegui_rag' trasforma in eccezioni) vengono marcate come errore e ritentate alla ripresa.
+            registro.write(json.dumps({**risultati_per_export[-1], "errore": isinstance(esito, Exception)}, ensure_ascii=False) + "\n")
+            registro.flush()
+            os.fsync(registro.fileno())
         
-        # Aggrega i punteggi per le risposte valide (non escluse).
-        if not is_contesto_insufficiente:
-            risultati_valutazione_validi.append(score)
-            if categoria not in risultati_per_categoria_validi:
-                risultati_per_categoria_validi[categoria] = []
-            risultati_per_categoria_validi[categoria].append(score)
+            # Le risposte valide (non escluse) riceveranno il punteggio di similarità.
+            if not is_contesto_insufficiente:
+                indici_validi.append(len(risultati_per_export) - 1)
+
+    # Salva nella cache le risposte ottenute senza errori, per riutilizzarle nelle prossime esecuzioni.
+    if EVAL_RAG_CACHE and esiti_futuri:
+        nuove_risposte = {d: list(f.result()) for d, f in esiti_futuri.items() if not isinstance(f.result(), Exception)}
+        cache_rag.setdefault(MODELLO_DA_USARE, {}).update(nuove_risposte)
+        with open(EVAL_RAG_CACHE, 'w', encoding='utf-8') as f:
+            json.dump(cache_rag, f, ensure_ascii=False, indent=2)
+        print(f"Cache RAG aggiornata con {len(nuove_risposte)} nuove risposte.")
+
+    # --- Calcolo dei Punteggi di Similarità ---
+    # Tutte le risposte valide vengono codificate con un'unica chiamata batch. Con embedding normalizzati
+    # la similarità del coseno coincide con il prodotto scalare, calcolato riga per riga su tutte le coppie.
+    if indici_validi:
+        print("Calcolo dei punteggi di similarità semantica...")
+        # I punteggi vengono accumulati in float32 anche se il modello produce vettori float16 (fp16 su GPU CUDA).
+        embedding_generati = model.encode(
+            [risultati_per_export[j]["risposta_generata"] for j in indici_validi],
+            batch_size=64,
+            normalize_embeddings=True
+        ).astype(np.float32, copy=False)
+        embedding_attesi = np.stack([embedding_ideali[risultati_per_export[j]["risposta_ideale"]] for j in indici_validi])
+        punteggi = (embedding_generati * embedding_attesi).sum(axis=1)
+
+        for j, score in zip(indici_validi, punteggi.tolist()):
+            risultati_per_export[j]["score"] = score
+            print(f"  - Elemento {j+1}: Punteggio Similarità Semantica = {score:.4f}")
 
     # --- Calcolo Finale dei Punteggi ---
     # Calcola il punteggio medio complessivo e il punteggio medio per ogni categoria.
-    punteggio_medio = sum(risultati_valutazione_validi) / len(risultati_valutazione_validi) if risultati_valutazione_validi else 0
-    punteggi_medi_categoria_dettagliati = {}
-    for cat in set(item['categoria'] for item in golden_dataset):
-        scores_validi = risultati_per_categoria_validi.get(cat, [])
-        media = sum(scores_validi) / len(scores_validi) if scores_validi else 0
-        totali_in_cat = sum(1 for item in golden_dataset if item['categoria'] == cat)
-        punteggi_medi_categoria_dettagliati[cat] = {'media': media, 'validi': len(scores_validi), 'totali': totali_in_cat}
+    # Le categorie vengono codificate come indici interi: somme e conteggi di tutte le categorie si ottengono
+    # con np.bincount in un'unica passata vettoriale, invece di scorrere il dataset una volta per categoria.
+    # Le risposte escluse hanno punteggio 0, quindi non alterano le somme.
+    categorie, id_categorie = np.unique([item['categoria'] for item in golden_dataset], return_inverse=True)
+    punteggi_elementi = np.array([risultato["score"] for risultato in risultati_per_export], dtype=np.float64)
+    maschera_validi = np.zeros(len(golden_dataset), dtype=bool)
+    maschera_validi[indici_validi] = True
+
+    totali_per_categoria = np.bincount(id_categorie, minlength=len(categorie))
+    validi_per_categoria = np.bincount(id_categorie, weights=maschera_validi, minlength=len(categorie))
+    somme_per_categoria = np.bincount(id_categorie, weights=punteggi_elementi, minlength=len(categorie))
+    medie_per_categoria = np.divide(somme_per_categoria, validi_per_categoria,
+                                    out=np.zeros(len(categorie)), where=validi_per_categoria > 0)
+
+    punteggio_medio = float(punteggi_elementi[maschera_validi].mean()) if indici_validi else 0
+    punteggi_medi_categoria_dettagliati = {
+        str(cat): {'media': float(media), 'validi': int(validi), 'totali': int(totali)}
+        for cat, media, validi, totali in zip(categorie, medie_per_categoria, validi_per_categoria, totali_per_categoria)
+    }
 
     # --- Stampa il Riepilogo Finale sulla Console ---
     print("\n\n--- RISULTATI FINALI DELLA VALUTAZIONE ---")
     print(f"Modello Valutato: {MODELLO_DA_USARE.upper()}")
     num_totali = len(golden_dataset)
-    num_validi = len(risultati_valutazione_validi)
+    num_validi = len(indici_validi)
     print(f"Campioni Totali: {num_totali}")
     print(f"Campioni Valutati (escluso 'Contesto non sufficiente'): {num_validi}")
     print(f"Punteggio Medio (sui campioni valutati): {punteggio_medio:.4f}")
@@ -268,5 +542,7 @@ if __name__ == "__main__":
     for categoria, dati in punteggi_medi_categoria_dettagliati.items():
         print(f"Categoria '{categoria}': Punteggio Medio = {dati['media']:.4f} ({dati['validi']}/{dati['totali']} campioni valutati)")
 
-    # Salva i risultati dettagliati in un file Excel.
-    salva_report_excel(risultati_per_export, punteggio_medio, punteggi_medi_categoria_dettagliati, num_validi, num_totali)
\ No newline at end of file
+    # Salva i risultati dettagliati in un file Excel. Una volta salvato il report, il registro dei
+    # risultati parziali non serve più: la prossima esecuzione ripartirà da zero.
+    if salva_report_excel(risultati_per_export, punteggio_medio, punteggi_medi_categoria_dettagliati, num_validi, num_totali):
+        os.remove(FILE_RISULTATI_PARZIALI)
\ No newline at end of file
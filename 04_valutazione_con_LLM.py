@@ -2,7 +2,11 @@
 # Versione aggiornata con la logica di formattazione fornita dall'utente.
 
 import os
+import re
 import sys
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 from datetime import datetime
 from dotenv import load_dotenv
@@ -10,7 +14,8 @@ from openai import AzureOpenAI
 import json
 from openpyxl import Workbook
 from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
-from openpyxl.utils.dataframe import dataframe_to_rows
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
 
 # --- Configurazione del Percorso ---
 script_directory = os.path.dirname(os.path.abspath(__file__))
@@ -22,25 +27,42 @@ FILE_REPORT_DA_VALUTARE = os.path.join(script_directory, nome_file_report)
 # Carica le variabili d'ambiente.
 load_dotenv()
 
-# Inizializza il client per il modello "giudice".
+# Numero di richieste al giudice eseguite in parallelo: ogni giudizio è una chiamata di rete ad Azure OpenAI,
+# quindi mentre un thread attende la risposta gli altri possono inviare le proprie richieste.
+JUDGE_WORKERS = int(os.getenv("JUDGE_WORKERS", "8"))
+
+# Inizializza il client per il modello "giudice". Il client è condiviso da tutti i thread; in caso di
+# throttling (429, rispettando l'intestazione Retry-After), timeout o errori temporanei (5xx) ripete la
+# richiesta con attesa esponenziale, fino a AZURE_OPENAI_MAX_RETRIES volte.
 try:
     judge_client = AzureOpenAI(
         api_key=os.getenv("AZURE_OPENAI_API_KEY"),
         api_version="2024-02-01",
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
+        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+        max_retries=int(os.getenv("AZURE_OPENAI_MAX_RETRIES", "6")),
+        timeout=float(os.getenv("AZURE_OPENAI_TIMEOUT", "60"))
     )
     JUDGE_MODEL_DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME", "gpt-4o")
 except Exception as e:
     print(f"Errore nell'inizializzazione del client di Azure: {e}")
     sys.exit(1)
 
-def ottieni_giudizio_dettagliato_llm(domanda: str, risposta_ideale: str, risposta_generata: str) -> dict:
-    """
-    Interroga un LLM "giudice" per ottenere una valutazione dettagliata su 5 metriche.
-    """
-    print(f"  - Richiesta di giudizio dettagliato per la domanda: '{domanda[:40]}...'")
+# Numero di righe valutate con una sola richiesta al giudice: il prompt di sistema e l'overhead della
+# chiamata vengono pagati una volta per blocco invece che per riga. 1 valuta ogni riga separatamente.
+JUDGE_BATCH_SIZE = int(os.getenv("JUDGE_BATCH_SIZE", "8"))
+
+# File in cui vengono conservati i giudizi già ottenuti, così una nuova esecuzione (es. dopo aver cambiato solo
+# la formattazione del report) non ripete le chiamate al giudice per le stesse righe. Vuota disattiva la cache.
+JUDGE_CACHE = os.getenv("JUDGE_CACHE", os.path.join(script_directory, "judge_cache.json"))
+
+# Campi restituiti dal giudice per ogni risposta valutata.
+CHIAVI_GIUDIZIO = [
+    "punteggio_chiarezza", "punteggio_rilevanza", "punteggio_correttezza",
+    "punteggio_completezza", "punteggio_coerenza", "giustificazione_generale"
+]
 
-    system_prompt = """
+# Prompt di sistema del giudice, condiviso da tutte le richieste.
+SYSTEM_PROMPT_GIUDICE = """
     Sei un valutatore esperto di sistemi RAG, specializzato in Ingegneria del Software e metodologie Agili.
     Il tuo compito è fornire una valutazione dettagliata della "Risposta Generata" rispetto a una "Risposta Ideale",
     considerando la "Domanda Originale".
@@ -57,6 +79,62 @@ def ottieni_giudizio_dettagliato_llm(domanda: str, risposta_ideale: str, rispost
     Se la "Risposta Generata" è "Contesto non sufficiente.", assegna 1 a tutti i punteggi.
     """
 
+# Istruzioni aggiuntive per valutare più righe con una sola richiesta.
+SYSTEM_PROMPT_GIUDICE_MULTIPLO = SYSTEM_PROMPT_GIUDICE + """
+    Riceverai un array JSON di elementi, ciascuno con le chiavi "id", "domanda", "risposta_ideale" e "risposta_generata".
+    Valuta ogni elemento in modo indipendente e rispondi SOLO con un oggetto JSON nella forma
+    {"verdicts": [{"id": <id dell'elemento>, <i 6 campi richiesti>}, ...]}, con un verdetto per ogni elemento ricevuto.
+    """
+
+# Risposta del writer quando il contesto recuperato non basta. Per regola del prompt il giudice le assegna 1 in
+# tutti i criteri: il giudizio viene quindi composto localmente, senza inviare la riga al giudice.
+CONTESTO_INSUFFICIENTE_RE = re.compile(r"\s*contesto non sufficiente\.?\s*", re.IGNORECASE)
+GIUDIZIO_CONTESTO_INSUFFICIENTE = {
+    "punteggio_chiarezza": 1, "punteggio_rilevanza": 1, "punteggio_correttezza": 1,
+    "punteggio_completezza": 1, "punteggio_coerenza": 1,
+    "giustificazione_generale": "Contesto non sufficiente: punteggi minimi assegnati senza interpellare il giudice."
+}
+
+# Versione del giudice: cambia automaticamente se cambiano i prompt o il deployment, invalidando la cache.
+VERSIONE_GIUDICE = hashlib.sha256(f"{JUDGE_MODEL_DEPLOYMENT}|{SYSTEM_PROMPT_GIUDICE_MULTIPLO}".encode("utf-8")).hexdigest()[:16]
+
+def chiave_giudizio(domanda: str, risposta_ideale: str, risposta_generata: str) -> str:
+    """
+    Calcola la chiave della cache dei giudizi per una riga del report.
+
+    Args:
+        domanda (str): La domanda originale.
+        risposta_ideale (str): La risposta ideale di riferimento.
+        risposta_generata (str): La risposta generata da valutare.
+
+    Returns:
+        str: L'hash SHA-256 della versione del giudice e dei tre testi.
+    """
+    return hashlib.sha256(f"{VERSIONE_GIUDICE}|{domanda}|{risposta_ideale}|{risposta_generata}".encode("utf-8")).hexdigest()
+
+def carica_cache_giudizi() -> dict[str, dict]:
+    """
+    Legge dal file JUDGE_CACHE i giudizi ottenuti nelle esecuzioni precedenti.
+
+    Returns:
+        dict[str, dict]: La mappa chiave della riga -> giudizio (vuota se la cache è disattivata, assente o illeggibile).
+    """
+    if not JUDGE_CACHE or not os.path.exists(JUDGE_CACHE):
+        return {}
+    try:
+        with open(JUDGE_CACHE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Attenzione: impossibile leggere la cache dei giudizi '{JUDGE_CACHE}' ({e}). Tutte le righe verranno rivalutate.")
+        return {}
+
+def ottieni_giudizio_dettagliato_llm(domanda: str, risposta_ideale: str, risposta_generata: str) -> dict:
+    """
+    Interroga un LLM "giudice" per ottenere una valutazione dettagliata su 5 metriche.
+    """
+    print(f"  - Richiesta di giudizio dettagliato per la domanda: '{domanda[:40]}...'")
+
+
     user_prompt = f"""
     Valuta la seguente risposta fornendo un JSON con i 6 campi richiesti:
     
@@ -79,7 +157,7 @@ def ottieni_giudizio_dettagliato_llm(domanda: str, risposta_ideale: str, rispost
         response = judge_client.chat.completions.create(
             model=JUDGE_MODEL_DEPLOYMENT,
             messages=[
-                {"role": "system", "content": system_prompt},
+                {"role": "system", "content": SYSTEM_PROMPT_GIUDICE},
                 {"role": "user", "content": user_prompt}
             ],
             temperature=0,
@@ -97,67 +175,108 @@ def ottieni_giudizio_dettagliato_llm(domanda: str, risposta_ideale: str, rispost
         default_error_response["giustificazione_generale"] = f"Errore: {e}"
         return default_error_response
 
+def ottieni_giudizi_llm_multipli(righe: list[tuple[int, str, str, str]]) -> dict[int, dict]:
+    """
+    Valuta più righe con una sola richiesta al giudice LLM. Se la risposta non contiene esattamente
+    un verdetto per ogni riga richiesta, ripiega sulla valutazione di una riga alla volta.
+
+    Args:
+        righe (list[tuple[int, str, str, str]]): Le righe da valutare come (id, domanda, risposta ideale, risposta generata).
+
+    Returns:
+        dict[int, dict]: La mappa id della riga -> giudizio, con le stesse chiavi di 'ottieni_giudizio_dettagliato_llm'.
+    """
+    if len(righe) == 1:
+        id_riga, domanda, risposta_ideale, risposta_generata = righe[0]
+        return {id_riga: ottieni_giudizio_dettagliato_llm(domanda, risposta_ideale, risposta_generata)}
+
+    print(f"  - Richiesta di giudizio dettagliato per {len(righe)} righe con una sola chiamata...")
+    elementi = [
+        {"id": id_riga, "domanda": domanda, "risposta_ideale": risposta_ideale, "risposta_generata": risposta_generata}
+        for id_riga, domanda, risposta_ideale, risposta_generata in righe
+    ]
+    user_prompt = f"Valuta i seguenti {len(elementi)} elementi fornendo i 6 campi richiesti per ciascuno:\n{json.dumps(elementi, ensure_ascii=False)}"
+
+    try:
+        response = judge_client.chat.completions.create(
+            model=JUDGE_MODEL_DEPLOYMENT,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT_GIUDICE_MULTIPLO},
+                {"role": "user", "content": user_prompt}
+            ],
+            temperature=0,
+            response_format={"type": "json_object"}
+        )
+        verdetti = {v.get("id"): v for v in json.loads(response.choices[0].message.content).get("verdicts", [])}
+        if set(verdetti) != {id_riga for id_riga, *_ in righe}:
+            raise ValueError(f"ricevuti i verdetti per gli id {sorted(verdetti, key=str)}")
+    except Exception as e:
+        print(f"    -> ERRORE durante la valutazione multipla ({e}). Valuto le righe una alla volta.")
+        return {
+            id_riga: ottieni_giudizio_dettagliato_llm(domanda, risposta_ideale, risposta_generata)
+            for id_riga, domanda, risposta_ideale, risposta_generata in righe
+        }
+
+    # Restituisce i verdetti nell'ordine delle righe, completando gli eventuali campi mancanti.
+    return {
+        id_riga: {key: verdetti[id_riga].get(key, 0 if 'punteggio' in key else "Mancante") for key in CHIAVI_GIUDIZIO}
+        for id_riga, *_ in righe
+    }
+
 def formatta_e_salva_report(df: pd.DataFrame, file_path: str):
     """
     Salva un DataFrame in un file Excel con la formattazione richiesta dall'utente.
     """
     print("\nSalvataggio del report formattato su file Excel...")
     try:
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Report Valutazione Giudice"
+        # Modalità write-only: le righe vengono scritte in streaming invece di restare in memoria come
+        # oggetti Cell, e ogni cella riceve il proprio stile una sola volta, nel momento in cui viene scritta.
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("Report Valutazione Giudice")
 
-        # Popola il foglio Excel con i dati del DataFrame, inclusa l'intestazione
-        for r in dataframe_to_rows(df, index=False, header=True):
-            ws.append(r)
+        def cella(value, **stile):
+            """Crea una cella per il foglio write-only con gli stili indicati (font, fill, alignment, border)."""
+            c = WriteOnlyCell(ws, value=value)
+            for attributo, valore in stile.items():
+                setattr(c, attributo, valore)
+            return c
+
+        # Imposta larghezza delle colonne (adattate per le nuove colonne). In write-only va fatto prima delle righe.
+        column_widths = {
+            'A': 20, 'B': 50, 'C': 50, 'D': 60, 'E': 60, 'F': 20, # Colonne originali
+            'G': 20, 'H': 20, 'I': 20, 'J': 20, 'K': 20, 'L': 60  # Colonne del giudice
+        }
+        col_letters = [get_column_letter(i) for i in range(1, len(df.columns) + 1)]
+        for col_letter in col_letters:
+            if col_letter in column_widths:
+                ws.column_dimensions[col_letter].width = column_widths[col_letter]
 
         # --- Stili di Formattazione (dallo snippet dell'utente) ---
+        # Creati una sola volta e condivisi da tutte le celle.
         header_font = Font(bold=True, color="FFFFFF")
         header_fill = PatternFill(start_color="4F81BD", end_color="4F81BD", fill_type="solid")
+        header_alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
         # Stile per le righe con punteggio 0 (rosso chiaro)
         score_zero_fill = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")
         thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+        data_style = {"alignment": Alignment(wrap_text=True, vertical="top"), "border": thin_border} # Allineamento in alto come da snippet
+        score_zero_style = {**data_style, "fill": score_zero_fill}
 
         # Applica stile all'intestazione
-        for cell in ws[1]:
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
-            cell.border = thin_border
-
-        # Trova l'indice della colonna "Punteggio Similarità"
-        punteggio_col_idx = -1
-        for idx, col_name in enumerate(df.columns, 1):
-            if col_name == "Punteggio Similarità":
-                punteggio_col_idx = idx
-                break
-
-        # Applica stile alle righe di dati
-        for row_index, row in enumerate(ws.iter_rows(min_row=2, max_row=ws.max_row), 2):
-            # Applica stile di base a tutte le celle della riga
-            for cell in row:
-                cell.alignment = Alignment(wrap_text=True, vertical="top") # Allineamento in alto come da snippet
-                cell.border = thin_border
-            
-            # --- LOGICA DI EVIDENZIAZIONE IN ROSSO ---
-            if punteggio_col_idx != -1:
-                punteggio_cell = ws.cell(row=row_index, column=punteggio_col_idx)
-                try:
-                    if float(punteggio_cell.value) == 0.0:
-                        for cell in row:
-                            cell.fill = score_zero_fill
-                except (ValueError, TypeError):
-                    pass
-
-        # Imposta larghezza delle colonne (adattate per le nuove colonne)
-        column_widths = {
-            'A': 20, 'B': 50, 'C': 50, 'D': 60, 'E': 60, 'F': 20, # Colonne originali
-            'G': 20, 'H': 20, 'I': 20, 'J': 20, 'K': 20, 'L': 60  # Colonne del giudice
-        }
-        col_letters = [chr(ord('A') + i) for i in range(len(df.columns))]
-        for i, col_letter in enumerate(col_letters):
-            if col_letter in column_widths:
-                 ws.column_dimensions[col_letter].width = column_widths[col_letter]
+        ws.append([cella(col_name, font=header_font, fill=header_fill, alignment=header_alignment, border=thin_border) for col_name in df.columns])
+
+        # --- LOGICA DI EVIDENZIAZIONE IN ROSSO ---
+        # Le righe con "Punteggio Similarità" pari a 0 vengono individuate con un'unica conversione vettoriale:
+        # i valori non numerici (o la colonna assente) non vengono evidenziati.
+        if "Punteggio Similarità" in df.columns:
+            score_zero_mask = pd.to_numeric(df["Punteggio Similarità"], errors="coerce").eq(0).to_numpy()
+        else:
+            score_zero_mask = np.zeros(len(df), dtype=bool)
+
+        # Scrive le righe di dati con il loro stile
+        for row, score_zero in zip(df.itertuples(index=False, name=None), score_zero_mask):
+            stile = score_zero_style if score_zero else data_style
+            ws.append([cella(value, **stile) for value in row])
 
         wb.save(file_path)
         print(f"✅ Report salvato con successo come '{file_path}'")
@@ -172,8 +291,15 @@ if __name__ == "__main__":
     print(f"Lettura del report di input da: '{FILE_REPORT_DA_VALUTARE}'")
 
     try:
-        df_full = pd.read_excel(FILE_REPORT_DA_VALUTARE)
-        df = df_full.head(26).copy()
+        # Vengono lette solo le sei colonne dei dati del report (A-F) e le prime 26 righe, invece dell'intero foglio.
+        # Se il pacchetto facoltativo python-calamine è installato, la lettura usa il suo parser nativo (Rust),
+        # molto più veloce di openpyxl; altrimenti ripiega su openpyxl. Senza il pacchetto pandas solleva ImportError,
+        # mentre le versioni di pandas precedenti alla 2.2 non conoscono il motore e sollevano ValueError.
+        opzioni_lettura = {"usecols": "A:F", "nrows": 26}
+        try:
+            df = pd.read_excel(FILE_REPORT_DA_VALUTARE, engine="calamine", **opzioni_lettura)
+        except (ImportError, ValueError):
+            df = pd.read_excel(FILE_REPORT_DA_VALUTARE, **opzioni_lettura)
         print(f"File letto con successo. Elaborazione delle prime {len(df)} righe.")
     except FileNotFoundError:
         print(f"ERRORE: File '{FILE_REPORT_DA_VALUTARE}' non trovato.")
@@ -186,30 +312,80 @@ if __name__ == "__main__":
         'Punteggio Chiarezza', 'Punteggio Rilevanza', 'Punteggio Correttezza',
         'Punteggio Completezza', 'Punteggio Coerenza', 'Giustificazione Giudice'
     ]
-    for col in nuove_colonne:
-        df[col] = ''
+    # Colonne di tipo object: devono contenere sia i punteggi numerici sia le giustificazioni testuali
+    # (con pandas 3 una colonna inizializzata con '' diventa di tipo stringa e rifiuta i numeri).
+    # Vengono aggiunte tutte insieme, come un unico blocco, invece che con un'assegnazione per colonna.
+    df = pd.concat([df, pd.DataFrame('', index=df.index, columns=nuove_colonne, dtype=object)], axis=1)
 
-    for index, row in df.iterrows():
-        print(f"\nValutazione riga {index + 1}/{len(df)}...")
-        
-        domanda = row['Domanda Originale']
-        risposta_ideale = row['Risposta Ideale']
-        risposta_generata = row['Risposta Generata']
-        
-        if pd.isna(risposta_generata):
-            print("  -> Risposta generata vuota. Salto.")
-            df.at[index, 'Giustificazione Giudice'] = "Risposta mancante nel report"
-            continue
+    # Le righe senza risposta generata non vengono inviate al giudice.
+    righe_mancanti = df['Risposta Generata'].isna()
+    df.loc[righe_mancanti, 'Giustificazione Giudice'] = "Risposta mancante nel report"
+    if righe_mancanti.any():
+        print(f"Righe con risposta generata vuota (saltate): {int(righe_mancanti.sum())}.")
+    righe_da_valutare = df[~righe_mancanti]
 
-        giudizio = ottieni_giudizio_dettagliato_llm(domanda, risposta_ideale, risposta_generata)
-        
-        df.at[index, 'Punteggio Chiarezza'] = giudizio.get('punteggio_chiarezza')
-        df.at[index, 'Punteggio Rilevanza'] = giudizio.get('punteggio_rilevanza')
-        df.at[index, 'Punteggio Correttezza'] = giudizio.get('punteggio_correttezza')
-        df.at[index, 'Punteggio Completezza'] = giudizio.get('punteggio_completezza')
-        df.at[index, 'Punteggio Coerenza'] = giudizio.get('punteggio_coerenza')
-        df.at[index, 'Giustificazione Giudice'] = giudizio.get('giustificazione_generale')
-        print(f"  -> Risultato: {giudizio}")
+    righe = list(zip(
+        righe_da_valutare.index,
+        righe_da_valutare['Domanda Originale'],
+        righe_da_valutare['Risposta Ideale'],
+        righe_da_valutare['Risposta Generata']
+    ))
+    chiavi = {index: chiave_giudizio(domanda, ideale, generata) for index, domanda, ideale, generata in righe}
+
+    # Le righe già giudicate in un'esecuzione precedente (stessi testi e stessa versione del giudice)
+    # riusano il giudizio salvato.
+    cache_giudizi = carica_cache_giudizi()
+    giudizi_per_chiave = {chiave: cache_giudizi[chiave] for chiave in set(chiavi.values()) if chiave in cache_giudizi}
+
+    # Le risposte "Contesto non sufficiente." ricevono il giudizio fisso senza alcuna chiamata.
+    righe_contesto_insufficiente = {
+        index for index, _, _, generata in righe if CONTESTO_INSUFFICIENTE_RE.fullmatch(str(generata))
+    }
+    for index in righe_contesto_insufficiente:
+        giudizi_per_chiave[chiavi[index]] = GIUDIZIO_CONTESTO_INSUFFICIENTE
+
+    # Le righe identiche (stessa domanda, risposta ideale e risposta generata, es. confrontando più esecuzioni)
+    # vengono inviate al giudice una sola volta: il giudizio viene poi assegnato a tutte le copie.
+    righe_uniche = {}
+    for riga in righe:
+        if chiavi[riga[0]] not in giudizi_per_chiave:
+            righe_uniche.setdefault(chiavi[riga[0]], riga)
+    righe_da_inviare = list(righe_uniche.values())
+    righe_in_cache = sum(chiavi[index] in cache_giudizi for index, *_ in righe if index not in righe_contesto_insufficiente)
+    print(f"Righe da valutare: {len(righe)} ({righe_in_cache} dalla cache, {len(righe_contesto_insufficiente)} con contesto non sufficiente, "
+          f"{len(righe_da_inviare)} righe distinte da inviare al giudice).")
+
+    # Le righe vengono raggruppate in blocchi di JUDGE_BATCH_SIZE, ciascuno valutato con una sola richiesta.
+    # I blocchi vengono richiesti in parallelo sul pool di thread; 'map' restituisce i risultati nell'ordine
+    # dei blocchi, quindi le stampe restano nello stesso ordine del report.
+    dimensione_blocco = max(JUDGE_BATCH_SIZE, 1)
+    blocchi = [righe_da_inviare[k:k + dimensione_blocco] for k in range(0, len(righe_da_inviare), dimensione_blocco)]
+
+    with ThreadPoolExecutor(max_workers=JUDGE_WORKERS) as executor:
+        for giudizi_blocco in executor.map(ottieni_giudizi_llm_multipli, blocchi):
+            for index, giudizio in giudizi_blocco.items():
+                print(f"\nValutazione riga {index + 1}/{len(df)}...")
+                print(f"  -> Risultato: {giudizio}")
+                giudizi_per_chiave[chiavi[index]] = giudizio
+
+    # Salva nella cache i nuovi giudizi, esclusi quelli non riusciti (da ritentare alla prossima esecuzione)
+    # e quelli fissi per contesto non sufficiente (ricalcolati senza costo a ogni esecuzione).
+    giudizi_nuovi = {
+        chiave: giudizio for chiave, giudizio in giudizi_per_chiave.items()
+        if chiave not in cache_giudizi and giudizio is not GIUDIZIO_CONTESTO_INSUFFICIENTE
+        and not str(giudizio.get('giustificazione_generale', '')).startswith("Errore")
+    }
+    if JUDGE_CACHE and giudizi_nuovi:
+        cache_giudizi.update(giudizi_nuovi)
+        with open(JUDGE_CACHE, 'w', encoding='utf-8') as f:
+            json.dump(cache_giudizi, f, ensure_ascii=False, indent=2)
+
+    # Assegna a ogni riga il giudizio dei suoi testi con un'unica assegnazione a blocco: i giudizi formano
+    # un DataFrame con lo stesso indice delle righe, le cui colonne (nell'ordine di CHIAVI_GIUDIZIO)
+    # corrispondono alle nuove colonne del report.
+    if righe:
+        verdetti = pd.DataFrame([giudizi_per_chiave[chiavi[index]] for index, *_ in righe], index=[index for index, *_ in righe])
+        df.loc[verdetti.index, nuove_colonne] = verdetti.reindex(columns=CHIAVI_GIUDIZIO).to_numpy()
 
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     base_name = nome_file_report.split('.xlsx')[0]
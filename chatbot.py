@@ -7,6 +7,7 @@
 import os
 import sys
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 # --- Setup del Percorso ---
@@ -16,7 +17,7 @@ sys.path.append(script_directory)
 
 # --- Importazione dei Moduli ---
 # Importa i moduli necessari dalla struttura del progetto.
-from index import product                           # Gestisce il passo di Recupero (Retrieval)
+from index import product, fondi_risultati_rrf      # Gestisce il passo di Recupero (Retrieval)
 from writer import writer_azure_openai, writer_ollama # Gestiscono il passo di Generazione (Generation)
 from query_rewriter import rewrite_query              # Gestisce il passo di Trasformazione della Query
 
@@ -24,8 +25,33 @@ from query_rewriter import rewrite_query              # Gestisce il passo di Tra
 # Carica le variabili d'ambiente (chiavi API, endpoint) dal file .env.
 load_dotenv()
 
+# Somiglianza minima (indice di Jaccard sulle parole) tra query riscritta e originale perché i documenti
+# recuperati in anticipo con la query originale vengano riutilizzati invece di ripetere la ricerca.
+RIUSO_RICERCA_SOGLIA = float(os.getenv("RIUSO_RICERCA_SOGLIA", "0.9"))
+
+# Se "true", quando la riscrittura cambia la query i documenti recuperati con la query originale non vengono
+# scartati ma fusi (Reciprocal Rank Fusion) con quelli della query riscritta: la ricerca anticipata, già pagata,
+# contribuisce al contesto e i chunk trovati da entrambe le query salgono in classifica. Disattivato per default.
+FUSIONE_RICERCHE = os.getenv("FUSIONE_RICERCHE", "false").lower() == "true"
+
+def somiglianza_parole(testo_a: str, testo_b: str) -> float:
+    """
+    Calcola l'indice di Jaccard tra gli insiemi di parole (in minuscolo) di due testi.
+
+    Args:
+        testo_a (str): Il primo testo.
+        testo_b (str): Il secondo testo.
+
+    Returns:
+        float: Un valore tra 0 (nessuna parola in comune) e 1 (stesse parole).
+    """
+    parole_a, parole_b = set(testo_a.lower().split()), set(testo_b.lower().split())
+    if not parole_a or not parole_b:
+        return 0.0
+    return len(parole_a & parole_b) / len(parole_a | parole_b)
+
 # --- Funzione Logica Principale del RAG ---
-def generate_user_story(user_query: str, model_name: str) -> str:
+def generate_user_story(user_query: str, model_name: str, stream: bool = False) -> str:
     """
     Esegue l'intera pipeline RAG per una data query dell'utente usando il modello selezionato.
     Questa funzione ora include il passo di riscrittura della query.
@@ -33,28 +59,38 @@ def generate_user_story(user_query: str, model_name: str) -> str:
     Args:
         user_query (str): La query originale inserita dall'utente.
         model_name (str): L'identificatore per il modello da usare ("azure" o "ollama").
+        stream (bool): Se True, la user story viene stampata a console man mano che viene generata
+            (modalità interattiva). Il testo completo viene restituito in entrambi i casi.
 
     Returns:
         str: La user story finale generata.
     """
     # 1. Riscrittura della Query: Per prima cosa, riscrive la query dell'utente per renderla più efficace per la ricerca semantica.
     # L'output a console per questo passo è gestito all'interno della funzione rewrite_query.
-    rewritten_search_query = rewrite_query(user_query, model_name)
-    
-    # Mantiene l'output a console rivolto all'utente in italiano.
-    print(f"\n...Recupero contesto per la query: '{rewritten_search_query}'...")
-    
-    # 2. Recupero: Usa la query riscritta per trovare i 6 chunk di documenti più pertinenti.
-    documents = product.find_products(context=rewritten_search_query, top=6)
+    # Mentre l'LLM riscrive la query, il recupero viene avviato in anticipo con la query originale:
+    # se la riscrittura la cambia solo marginalmente, i documenti sono già pronti.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futuro_riscrittura = executor.submit(rewrite_query, user_query, model_name)
+        futuro_documenti = executor.submit(product.find_products, user_query, 6)
+        rewritten_search_query = futuro_riscrittura.result()
+
+        # 2. Recupero: Usa la query riscritta per trovare i 6 chunk di documenti più pertinenti.
+        if somiglianza_parole(user_query, rewritten_search_query) >= RIUSO_RICERCA_SOGLIA:
+            print("\n...Query riscritta equivalente all'originale: riuso il contesto recuperato in anticipo...")
+            documents = futuro_documenti.result()
+        else:
+            # Mantiene l'output a console rivolto all'utente in italiano.
+            print(f"\n...Recupero contesto per la query: '{rewritten_search_query}'...")
+            documents = product.find_products(context=rewritten_search_query, top=6)
+            if FUSIONE_RICERCHE:
+                documents = fondi_risultati_rrf([documents, futuro_documenti.result()], top=6)
     
     # 3. Aumento: Prepara il contesto recuperato per il prompt finale.
     if not documents:
         context_for_prompt = "Nessun contesto specifico trovato nella base di conoscenza."
         print("⚠️  Nessun contesto pertinente trovato.")
     else:
-        context_for_prompt = "\n\n---\n\n".join(
-            [doc.get("content", "") for doc in documents]
-        )
+        context_for_prompt = "\n\n---\n\n".join(documents)
         print(f"✅  Contesto basato su {len(documents)} documenti recuperato.")
 
     # 4. Generazione: Seleziona la funzione di scrittura appropriata in base al modello scelto.
@@ -69,12 +105,15 @@ def generate_user_story(user_query: str, model_name: str) -> str:
         return f"Errore: Modello '{model_name}' non riconosciuto."
         
     print(f"...Genero la user story con {model_name.upper()}...")
+    if stream:
+        print("\n--- User Story Generata ---")
     
     # La chiamata finale allo scrittore usa il contesto aumentato ma la query ORIGINALE dell'utente
     # per garantire che la storia generata risponda direttamente alla richiesta iniziale.
     final_response = writer_function(
         productContext=context_for_prompt,
-        assignment=user_query
+        assignment=user_query,
+        stream=stream
     )
     
     return final_response
@@ -129,9 +168,6 @@ if __name__ == "__main__":
                 break
             
             # Per ogni input, esegue l'intera pipeline RAG con il riscrittore di query.
-            user_story = generate_user_story(user_input, selected_model)
-            
-            # Stampa il risultato formattato.
-            print("\n--- User Story Generata ---")
-            print(user_story.strip())
+            # La user story viene stampata token per token man mano che il modello la genera.
+            generate_user_story(user_input, selected_model, stream=True)
             print("---------------------------\n")
\ No newline at end of file
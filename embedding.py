@@ -0,0 +1,225 @@
+# embedding.py
+# Questo modulo centralizza il caricamento del modello di embedding SentenceTransformer.
+# Indicizzazione, recupero e valutazione devono usare lo stesso modello, così che documenti
+# e query vivano nello stesso spazio vettoriale: tenere qui la configurazione evita che
+# gli script divergano.
+
+import os
+import numpy as np
+import requests
+import torch
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from sentence_transformers import SentenceTransformer
+from dotenv import load_dotenv
+
+# Carica le variabili d'ambiente dal file .env: il modulo legge la propria configurazione al momento
+# dell'importazione, che può precedere il 'load_dotenv' dello script che lo importa.
+load_dotenv()
+
+# Il modello di embedding usato in tutto il progetto (vettori a 384 dimensioni).
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", 'paraphrase-multilingual-MiniLM-L12-v2')
+
+# --- Troncamento Matryoshka ---
+# Con un modello addestrato con Matryoshka Representation Learning (es. 'mixedbread-ai/mxbai-embed-large-v1')
+# le prime N dimensioni del vettore sono già un embedding valido: troncarle riduce in proporzione la memoria
+# dell'indice e il costo di ogni confronto. Il vettore viene troncato prima della normalizzazione.
+# Il modello predefinito non è addestrato in questo modo, quindi va lasciata vuota (nessun troncamento).
+# Il valore deve coincidere con 'dimensions' dello schema dell'indice (vedi 01_crea_indice.py).
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS")) if os.getenv("EMBEDDING_DIMENSIONS") else None
+
+# --- Configurazione del Backend di Inferenza ---
+# "torch" (predefinito) esegue il modello con PyTorch. "onnx" e "openvino" usano runtime con kernel
+# fusi e ottimizzazioni del grafo, in genere 2-4 volte più veloci su CPU. Il repository del modello
+# su Hugging Face contiene già le esportazioni ottimizzate (es. "model_O4.onnx", "model_qint8_avx512_vnni.onnx"),
+# selezionabili con EMBEDDING_MODEL_FILE. Il nome è relativo alla sottocartella del backend (es. "onnx/").
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower()
+EMBEDDING_MODEL_FILE = os.getenv("EMBEDDING_MODEL_FILE")
+# Execution provider di ONNX Runtime (es. "CUDAExecutionProvider" per la GPU, "CPUExecutionProvider").
+# Se non impostato, ONNX Runtime usa il primo provider disponibile.
+EMBEDDING_ONNX_PROVIDER = os.getenv("EMBEDDING_ONNX_PROVIDER")
+
+# Numero massimo di token elaborati per testo; quelli oltre vengono troncati. 128 è il limite con cui
+# il modello predefinito è stato addestrato: va fissato esplicitamente perché il chunking vi si allinea.
+EMBEDDING_MAX_SEQ_LENGTH = int(os.getenv("EMBEDDING_MAX_SEQ_LENGTH", "128"))
+
+# --- Configurazione della Precisione dei Pesi (solo backend torch) ---
+# "fp32" mantiene i pesi originali. "fp16" dimezza i pesi su GPU e accelera le moltiplicazioni di matrici
+# (Tensor Core); "int8" applica la quantizzazione dinamica dei layer lineari, il caso favorevole su CPU.
+# "bf16" dimezza i pesi mantenendo l'intervallo dei valori di fp32: è utile su GPU recenti e sulle CPU con
+# istruzioni bf16 native (AVX512-BF16, AMX), mentre sulle altre CPU è più lento di fp32.
+# "auto" (predefinito) usa fp16 se il modello è su una GPU CUDA e fp32 altrimenti.
+# Gli embedding cambiano solo di poco, ma documenti e query vanno codificati con la stessa impostazione.
+EMBEDDING_PRECISION = os.getenv("EMBEDDING_PRECISION", "auto").lower()
+
+# Thread usati da PyTorch per l'inferenza su CPU. Per default PyTorch usa tutti i core fisici, ma in container
+# o con un OMP_NUM_THREADS ereditato dall'ambiente può ritrovarsi con un solo thread: impostandolo si fissa
+# esplicitamente il parallelismo del forward pass. Vuota (predefinito) lascia la scelta a PyTorch.
+EMBEDDING_NUM_THREADS = int(os.getenv("EMBEDDING_NUM_THREADS")) if os.getenv("EMBEDDING_NUM_THREADS") else None
+
+# Se "true", con il backend torch il transformer viene compilato con torch.compile: il primo 'encode' richiede
+# da qualche secondo a qualche decina di secondi di compilazione, poi i passaggi successivi usano kernel fusi.
+# Conviene solo ai processi che codificano molti testi (indicizzazione, valutazione). Disattivato per default.
+EMBEDDING_COMPILE = os.getenv("EMBEDDING_COMPILE", "false").lower() == "true"
+
+# --- Server di Embedding Condiviso (Facoltativo) ---
+# URL di un server text-embeddings-inference (TEI) che espone lo stesso modello, ad esempio avviato con:
+#   docker run --gpus all -p 8080:80 ghcr.io/huggingface/text-embeddings-inference:latest \
+#       --model-id sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2
+# Se impostato, gli script inviano i testi al server invece di caricare il modello: il caricamento avviene una
+# volta sola per tutti gli script, e il server raggruppa in micro-batch le richieste di più client contemporanei.
+EMBEDDING_SERVER_URL = os.getenv("EMBEDDING_SERVER_URL")
+# Testi inviati al server per ogni richiesta (TEI accetta per default al massimo 32 testi per richiesta).
+EMBEDDING_SERVER_BATCH_SIZE = int(os.getenv("EMBEDDING_SERVER_BATCH_SIZE", "32"))
+
+class RemoteEmbeddingModel:
+    """
+    Client per un server text-embeddings-inference con la stessa interfaccia di SentenceTransformer
+    usata dagli script ('encode', 'tokenizer', 'max_seq_length'). Il tokenizer viene comunque caricato
+    in locale, perché il chunking in 02_popola_indice.py misura i testi in token del modello.
+    """
+
+    def __init__(self, server_url: str):
+        from transformers import AutoTokenizer
+
+        self.url = f"{server_url.rstrip('/')}/embed"
+        model_id = EMBEDDING_MODEL_NAME if "/" in EMBEDDING_MODEL_NAME else f"sentence-transformers/{EMBEDDING_MODEL_NAME}"
+        self.tokenizer = AutoTokenizer.from_pretrained(model_id)
+        self.max_seq_length = EMBEDDING_MAX_SEQ_LENGTH
+        # Una sola sessione riutilizza le connessioni; le richieste vengono ripetute se il server è
+        # momentaneamente sovraccarico (429) o non ancora pronto (503).
+        self.session = requests.Session()
+        adapter = HTTPAdapter(max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 503], allowed_methods=None))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def encode(self, sentences: str | list[str], batch_size: int = EMBEDDING_SERVER_BATCH_SIZE,
+               normalize_embeddings: bool = False, **kwargs) -> np.ndarray:
+        """
+        Calcola gli embedding sul server, inviando i testi a blocchi di 'batch_size'.
+
+        Args:
+            sentences (str | list[str]): Il testo o la lista di testi da codificare.
+            batch_size (int): Il numero massimo di testi per richiesta (limitato a EMBEDDING_SERVER_BATCH_SIZE).
+            normalize_embeddings (bool): Se True, normalizza i vettori a lunghezza unitaria.
+            **kwargs: Gli altri argomenti di SentenceTransformer.encode, ignorati.
+
+        Returns:
+            np.ndarray: Un vettore per un singolo testo, altrimenti una matrice con una riga per testo.
+        """
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        batch_size = min(batch_size, EMBEDDING_SERVER_BATCH_SIZE)
+        vectors = []
+        for start in range(0, len(texts), batch_size):
+            # La normalizzazione avviene in locale, dopo l'eventuale troncamento Matryoshka, come in SentenceTransformer.
+            response = self.session.post(self.url, json={"inputs": texts[start:start + batch_size], "truncate": True, "normalize": False})
+            response.raise_for_status()
+            vectors.extend(response.json())
+
+        embeddings = np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+        if EMBEDDING_DIMENSIONS:
+            embeddings = embeddings[:, :EMBEDDING_DIMENSIONS]
+        if normalize_embeddings:
+            embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings[0] if single else embeddings
+
+def load_embedding_model() -> SentenceTransformer | RemoteEmbeddingModel:
+    """
+    Carica il modello di embedding con il backend configurato tramite le variabili d'ambiente.
+    Se EMBEDDING_SERVER_URL è impostato, restituisce invece il client per il server di embedding.
+
+    Returns:
+        SentenceTransformer | RemoteEmbeddingModel: Il modello (o il client del server) pronto per chiamare 'encode'.
+    """
+    if EMBEDDING_SERVER_URL:
+        return RemoteEmbeddingModel(EMBEDDING_SERVER_URL)
+
+    model, precision = _carica_modello_locale()
+    # La precisione effettiva (dopo la risoluzione di "auto" e gli eventuali ripieghi su fp32) entra nella
+    # firma della configurazione (vedi 'embedding_signature').
+    model.embedding_precision = precision
+    if EMBEDDING_COMPILE and EMBEDDING_BACKEND == "torch":
+        # Viene compilato sul posto il modulo Transformer (il primo del SentenceTransformer). 'dynamic=True' evita una
+        # ricompilazione per ogni diversa lunghezza dei testi. La codifica di prova paga il costo della compilazione
+        # subito, invece che alla prima richiesta reale.
+        model[0].compile(dynamic=True)
+        model.encode(["Compilazione del modello di embedding.", "Testo di prova."])
+    return model
+
+def embedding_signature(model: SentenceTransformer | RemoteEmbeddingModel) -> str:
+    """
+    Descrive la configurazione che produce effettivamente i vettori di un modello caricato con 'load_embedding_model':
+    modello, dimensioni, lunghezza massima e, in locale, backend, file esportato, precisione risolta e dispositivo
+    (con il server di embedding, il suo URL). Configurazioni con firme diverse possono produrre vettori diversi,
+    quindi la firma identifica gli embedding salvati in una cache.
+
+    Args:
+        model (SentenceTransformer | RemoteEmbeddingModel): Il modello restituito da 'load_embedding_model'.
+
+    Returns:
+        str: La firma della configurazione.
+    """
+    signature = f"{EMBEDDING_MODEL_NAME}|dim={EMBEDDING_DIMENSIONS}|max_seq={EMBEDDING_MAX_SEQ_LENGTH}"
+    if isinstance(model, RemoteEmbeddingModel):
+        return f"{signature}|server={EMBEDDING_SERVER_URL}"
+    signature += f"|backend={EMBEDDING_BACKEND}|precision={model.embedding_precision}|device={model.device.type}"
+    if EMBEDDING_BACKEND != "torch":
+        signature += f"|file={EMBEDDING_MODEL_FILE}|provider={EMBEDDING_ONNX_PROVIDER}"
+    return signature
+
+def _carica_modello_locale() -> tuple[SentenceTransformer, str]:
+    """
+    Carica il modello SentenceTransformer in locale con il backend e la precisione configurati.
+
+    Returns:
+        tuple[SentenceTransformer, str]: Il modello pronto per chiamare 'encode' e la precisione effettivamente applicata.
+    """
+    if EMBEDDING_BACKEND not in ("torch", "onnx", "openvino"):
+        raise ValueError(f"EMBEDDING_BACKEND non valido: '{EMBEDDING_BACKEND}'. Valori ammessi: torch, onnx, openvino.")
+
+    model_kwargs = {}
+    if EMBEDDING_MODEL_FILE and EMBEDDING_BACKEND != "torch":
+        model_kwargs["file_name"] = EMBEDDING_MODEL_FILE
+    if EMBEDDING_ONNX_PROVIDER and EMBEDDING_BACKEND == "onnx":
+        model_kwargs["provider"] = EMBEDDING_ONNX_PROVIDER
+
+    if EMBEDDING_PRECISION not in ("auto", "fp32", "fp16", "bf16", "int8"):
+        raise ValueError(f"EMBEDDING_PRECISION non valido: '{EMBEDDING_PRECISION}'. Valori ammessi: auto, fp32, fp16, bf16, int8.")
+
+    if EMBEDDING_NUM_THREADS and EMBEDDING_BACKEND == "torch":
+        torch.set_num_threads(EMBEDDING_NUM_THREADS)
+
+    model = SentenceTransformer(EMBEDDING_MODEL_NAME, backend=EMBEDDING_BACKEND, model_kwargs=model_kwargs or None,
+                                truncate_dim=EMBEDDING_DIMENSIONS)
+    model.max_seq_length = EMBEDDING_MAX_SEQ_LENGTH
+
+    precision = EMBEDDING_PRECISION
+    if precision == "auto":
+        # SentenceTransformer sceglie da solo la GPU CUDA, se disponibile.
+        precision = "fp16" if EMBEDDING_BACKEND == "torch" and model.device.type == "cuda" else "fp32"
+
+    if precision == "fp32":
+        return model, "fp32"
+    if EMBEDDING_BACKEND != "torch":
+        # I backend onnx/openvino scelgono la precisione tramite il file esportato (EMBEDDING_MODEL_FILE).
+        print(f"Attenzione: EMBEDDING_PRECISION='{precision}' è supportato solo con il backend torch. Uso fp32.")
+        return model, "fp32"
+
+    if precision == "fp16":
+        if model.device.type != "cuda":
+            # Su CPU i kernel fp16 sono spesso più lenti di quelli fp32.
+            print("Attenzione: EMBEDDING_PRECISION='fp16' richiede una GPU CUDA. Uso fp32.")
+            return model, "fp32"
+        return model.half(), "fp16"
+
+    if precision == "bf16":
+        # SentenceTransformer riconverte gli embedding bf16 in float32 prima di restituirli come array numpy.
+        return model.to(torch.bfloat16), "bf16"
+
+    # Quantizzazione dinamica int8: i pesi dei layer lineari vengono salvati in int8 e le attivazioni
+    # quantizzate al volo. È pensata per l'inferenza su CPU.
+    if model.device.type != "cpu":
+        print("Attenzione: EMBEDDING_PRECISION='int8' è supportato solo su CPU. Uso fp32.")
+        return model, "fp32"
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8), "int8"
@@ -5,11 +5,18 @@
 # to find the most semantically similar text chunks from the knowledge base.
 
 import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
 from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
 from azure.search.documents import SearchClient
 from azure.search.documents.models import VectorizedQuery
 from dotenv import load_dotenv
-from sentence_transformers import SentenceTransformer
+from embedding import load_embedding_model
 
 # Carica le variabili d'ambiente dal file .env
 load_dotenv()
@@ -20,42 +27,117 @@ AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT")
 AZURE_SEARCH_API_KEY = os.getenv("AZURE_SEARCH_API_KEY")
 AZURE_SEARCH_INDEX_NAME = os.getenv("AZURE_SEARCH_INDEX_NAME")
 
+# Numero di query (con il rispettivo 'top') i cui risultati, e i cui vettori, restano in memoria: il chatbot e la
+# valutazione ripetono spesso la stessa query riscritta, che viene così servita senza codifica né ricerca. 0 disattiva la cache.
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "1024"))
+
+# Similarità coseno minima perché una query riceva i risultati di una query precedente già cercata (con lo stesso
+# 'top') invece di una nuova ricerca: query formulate diversamente ma quasi identiche nel significato recuperano in
+# pratica gli stessi chunk. Vuota (predefinito) disattiva questa cache semantica; un valore tipico è 0.97.
+SEARCH_SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEARCH_SEMANTIC_CACHE_THRESHOLD")) if os.getenv("SEARCH_SEMANTIC_CACHE_THRESHOLD") else None
+
 #--- CARICAMENTO DEL MODELLO DI EMBEDDING LOCALE ---
 # Carica il modello SentenceTransformer direttamente in memoria.
 # Questo stesso modello viene utilizzato sia per l'indicizzazione dei documenti (in 02_popola_indice.py)
 # sia per le query, il che è cruciale per garantire che la query e i documenti esistano
-# nello stesso spazio vettoriale.
+# nello stesso spazio vettoriale. Per questo la configurazione (modello, backend, dimensioni) è condivisa in embedding.py.
+# Il modello viene caricato alla prima codifica, non all'importazione: chi importa il modulo senza cercare
+# non paga il caricamento, e nel chatbot questo si sovrappone alla prima riscrittura della query.
+_embedding_model = None
+_model_lock = threading.Lock()
+
+def get_embedding_model():
+    """
+    Restituisce il modello di embedding condiviso, caricandolo alla prima chiamata.
+
+    Returns:
+        SentenceTransformer | RemoteEmbeddingModel: Il modello restituito da load_embedding_model().
+    """
+    global _embedding_model
+    # Il lock garantisce che thread concorrenti (es. la valutazione parallela) non carichino il modello due volte.
+    with _model_lock:
+        if _embedding_model is None:
+            print("🔎 Caricamento del modello di embedding locale per la ricerca...")
+            _embedding_model = load_embedding_model()
+            print("✅ Modello di embedding locale caricato.")
+    return _embedding_model
 
-print("🔎 Caricamento del modello di embedding locale per la ricerca...")
-embedding_model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
-print("✅ Modello di embedding locale caricato.")
+# Il tokenizer del modello modifica il proprio stato a ogni chiamata e non può essere usato da più
+# thread contemporaneamente (es. la valutazione parallela in 03_valuta_modello.py): le codifiche
+# delle query vengono serializzate. Codificare una query richiede pochi millisecondi.
+_encode_lock = threading.Lock()
+
+# Vettori delle query già codificate, dal meno al più recentemente usato (protetti da _encode_lock).
+_vettori_query: OrderedDict[str, np.ndarray] = OrderedDict()
+
+# Cache semantica: per ogni (query, top) già cercata, il vettore della query e i risultati ottenuti.
+_ricerche_semantiche: OrderedDict[tuple[str, int], tuple[np.ndarray, tuple[str, ...]]] = OrderedDict()
+_semantica_lock = threading.Lock()
 
 # Inizializza il client per Azure AI Search.
 # Questo oggetto client gestirà tutte le comunicazioni con il servizio di ricerca.
+# Il client mantiene aperte le connessioni HTTPS tra una query e l'altra (chatbot, valutazione), ma il pool
+# predefinito di requests ne conserva 10 per host: con più ricerche parallele in 03_valuta_modello.py
+# (EVAL_WORKERS) le connessioni in eccesso verrebbero chiuse e riaperte, con un nuovo handshake TLS.
+_search_session = requests.Session()
+_search_session.mount("https://", HTTPAdapter(pool_maxsize=max(10, int(os.getenv("EVAL_WORKERS", "4")))))
 search_client = SearchClient(
     endpoint=AZURE_SEARCH_ENDPOINT,
     index_name=AZURE_SEARCH_INDEX_NAME,
-    credential=AzureKeyCredential(AZURE_SEARCH_API_KEY)
+    credential=AzureKeyCredential(AZURE_SEARCH_API_KEY),
+    transport=RequestsTransport(session=_search_session)
 )
 
-def find_products(context: str, top: int = 6) -> list[dict]:
+def codifica_query(contexts: list[str]) -> list[np.ndarray]:
     """
-    Performs a semantic search on the Azure AI Search index.
+    Restituisce i vettori normalizzati delle query, codificando con un solo passaggio del modello
+    quelle non ancora presenti nella cache. Chiamarla in anticipo con tutte le query note (es. le domande
+    riformulate della valutazione) evita un passaggio del modello per ogni ricerca successiva.
 
-    This function takes a text query, converts it to a vector embedding locally,
-    and then sends that vector to Azure to find the 'top' k-nearest neighbors
-    (i.e., the most relevant text chunks).
+    Args:
+        contexts (list[str]): Le query da codificare.
+
+    Returns:
+        list[np.ndarray]: Un vettore float32 per ogni query, nello stesso ordine.
+    """
+    with _encode_lock:
+        # Gli spazi iniziali e finali non cambiano i token, quindi le query vengono confrontate senza.
+        chiavi = [context.strip() for context in contexts]
+        mancanti = list(dict.fromkeys(chiave for chiave in chiavi if chiave not in _vettori_query))
+        if mancanti:
+            embeddings = get_embedding_model().encode(mancanti, batch_size=32, normalize_embeddings=True)
+            _vettori_query.update(zip(mancanti, np.asarray(embeddings, dtype=np.float32)))
+
+        vettori = []
+        for chiave in chiavi:
+            _vettori_query.move_to_end(chiave)
+            vettori.append(_vettori_query[chiave])
+        while len(_vettori_query) > SEARCH_CACHE_SIZE:
+            _vettori_query.popitem(last=False)
+    return vettori
+
+@lru_cache(maxsize=SEARCH_CACHE_SIZE)
+def _cerca(context: str, top: int) -> tuple[str, ...]:
+    """
+    Codifica la query ed esegue la ricerca vettoriale. I testi trovati vengono memorizzati per
+    (context, top) in una tupla, così che la cache non venga modificata dai chiamanti.
 
     Args:
-        context (str): The user query (or rewritten query) to search for.
-        top (int): The number of top results to retrieve. Defaults to 6.
+        context (str): La query da cercare.
+        top (int): Il numero di risultati da recuperare.
 
     Returns:
-        list[dict]: A list of the search result documents.
+        tuple[str, ...]: Il contenuto testuale dei chunk trovati.
     """
     # 1. Vettorizza la Query: Converte il testo di input 'context' in un vettore
-    #a 384 dimensioni usando il modello di embedding caricato localmente.
-    query_vector = embedding_model.encode(context).tolist()
+    #(a 384 dimensioni, salvo troncamento) usando il modello di embedding caricato localmente.
+    #Il vettore viene normalizzato come quelli dei documenti, perché l'indice usa il prodotto scalare.
+    vettore = codifica_query([context])[0]
+    if SEARCH_SEMANTIC_CACHE_THRESHOLD is not None:
+        risultati = _cerca_query_simile(vettore, top)
+        if risultati is not None:
+            return risultati
+    query_vector = vettore.tolist()
 
     # 2. Costruisci la Query Vettoriale: Costruisce un oggetto di query di ricerca che
     #Azure AI Search comprende. Questo specifica il vettore da cercare, quanti vicini
@@ -74,18 +156,104 @@ def find_products(context: str, top: int = 6) -> list[dict]:
         vector_queries=[vector_query],
         select=["content"]
     )
-    
-    # Convert the iterator of results into a list.
-    contesto_recuperato = [result for result in results]
+    # Dai risultati serve solo il testo: gli oggetti dell'SDK non vengono conservati.
+    risultati = tuple(result["content"] for result in results)
+    if SEARCH_SEMANTIC_CACHE_THRESHOLD is not None:
+        with _semantica_lock:
+            _ricerche_semantiche[(context, top)] = (vettore, risultati)
+            while len(_ricerche_semantiche) > SEARCH_CACHE_SIZE:
+                _ricerche_semantiche.popitem(last=False)
+    return risultati
+
+def _cerca_query_simile(vettore: np.ndarray, top: int) -> tuple[str, ...] | None:
+    """
+    Cerca nella cache semantica una query già eseguita con lo stesso 'top' e un vettore abbastanza simile.
+    I vettori sono normalizzati, quindi il prodotto scalare è la similarità coseno: con al massimo
+    SEARCH_CACHE_SIZE query memorizzate basta un unico prodotto matrice-vettore.
+
+    Args:
+        vettore (np.ndarray): Il vettore normalizzato della nuova query.
+        top (int): Il numero di risultati richiesti.
+
+    Returns:
+        tuple[str, ...] | None: I risultati della query più simile, o None se nessuna supera la soglia.
+    """
+    with _semantica_lock:
+        candidati = [(chiave, voce) for chiave, voce in _ricerche_semantiche.items() if chiave[1] == top]
+        if not candidati:
+            return None
+        similarita = np.stack([voce[0] for _, voce in candidati]) @ vettore
+        migliore = int(np.argmax(similarita))
+        if similarita[migliore] < SEARCH_SEMANTIC_CACHE_THRESHOLD:
+            return None
+        chiave, (_, risultati) = candidati[migliore]
+        _ricerche_semantiche.move_to_end(chiave)
+        return risultati
+
+def find_products(context: str, top: int = 6) -> list[str]:
+    """
+    Performs a semantic search on the Azure AI Search index.
+
+    This function takes a text query, converts it to a vector embedding locally,
+    and then sends that vector to Azure to find the 'top' k-nearest neighbors
+    (i.e., the most relevant text chunks). Repeated queries are served from an
+    in-memory cache (see SEARCH_CACHE_SIZE).
+
+    Args:
+        context (str): The user query (or rewritten query) to search for.
+        top (int): The number of top results to retrieve. Defaults to 6.
+
+    Returns:
+        list[str]: The text content of the retrieved chunks.
+    """
+    contesto_recuperato = list(_cerca(context, top))
     print(f"✅ Contesto recuperato: {len(contesto_recuperato)} chunk trovati.")
     return contesto_recuperato
 
+def find_products_batch(contexts: list[str], top: int = 6) -> list[list[str]]:
+    """
+    Performs a semantic search for several queries, encoding all of them in a single
+    forward pass of the embedding model before running the searches.
+
+    Args:
+        contexts (list[str]): The queries to search for.
+        top (int): The number of top results to retrieve per query. Defaults to 6.
+
+    Returns:
+        list[list[str]]: The text content of the retrieved chunks, one list per query.
+    """
+    codifica_query(contexts)
+    return [find_products(context, top) for context in contexts]
+
+def fondi_risultati_rrf(liste_risultati: list[list[str]], top: int = 6, k: int = 60) -> list[str]:
+    """
+    Unisce i risultati di più ricerche con la Reciprocal Rank Fusion: ogni chunk riceve 1 / (k + posizione)
+    da ogni lista in cui compare, e vengono restituiti i 'top' chunk con il punteggio totale più alto.
+    I chunk trovati da più query salgono in classifica; a parità di punteggio prevale l'ordine delle liste.
+
+    Args:
+        liste_risultati (list[list[str]]): I risultati di ciascuna ricerca, dal più al meno pertinente.
+        top (int): Il numero di chunk da restituire. Defaults to 6.
+        k (int): La costante di smorzamento della RRF (60 è il valore dell'articolo originale). Defaults to 60.
+
+    Returns:
+        list[str]: I chunk fusi, dal più al meno pertinente.
+    """
+    punteggi: dict[str, float] = {}
+    for risultati in liste_risultati:
+        for posizione, chunk in enumerate(risultati, start=1):
+            punteggi[chunk] = punteggi.get(chunk, 0.0) + 1.0 / (k + posizione)
+    return sorted(punteggi, key=punteggi.get, reverse=True)[:top]
+
 # Questa classe agisce come un semplice wrapper attorno alla funzione find_products.
 # È stata creata per fornire un'interfaccia orientata agli oggetti coerente (`product.find_products`)
 # che viene utilizzata in altri script come il chatbot e lo script di valutazione.
 class ProductFinder:
-    def find_products(self, context: str, top: int = 6):
+    def find_products(self, context: str, top: int = 6) -> list[str]:
         return find_products(context, top)
 
+    def find_products_batch(self, contexts: list[str], top: int = 6) -> list[list[str]]:
+        return find_products_batch(contexts, top)
+
 # Istanzia il finder in modo che altri moduli possano importarlo e usarlo direttamente.
 product = ProductFinder()
\ No newline at end of file
@@ -5,9 +5,149 @@
 # per una ricerca vettoriale in una base di conoscenza tecnica.
 
 import os
+import re
+import json
+from functools import lru_cache
 import ollama
 from openai import AzureOpenAI
 
+# Questo è un "meta-prompt" progettato specificamente per il compito di riscrittura.
+# Istruisce l'LLM ad agire come un esperto di recupero dell'informazione e a
+# riformulare soltanto la query, non a rispondere. Ciò garantisce che l'output sia pulito e mirato.
+SYSTEM_PROMPT_RISCRITTURA = (
+    "Sei un assistente AI esperto in information retrieval. Il tuo unico compito è prendere una richiesta utente, "
+    "spesso breve o ambigua, e trasformarla in una query di ricerca dettagliata e semanticamente ricca. "
+    "La query ottimizzata deve essere ideale per una ricerca vettoriale in una base di conoscenza tecnica. "
+    "NON rispondere alla domanda, ma RIFORMULALA.\n"
+    "Restituisci solo ed esclusivamente la query migliorata, senza alcuna frase introduttiva o di contorno."
+)
+
+# Variante del meta-prompt per riscrivere più richieste con una sola chiamata all'LLM.
+SYSTEM_PROMPT_RISCRITTURA_MULTIPLA = (
+    "Sei un assistente AI esperto in information retrieval. Il tuo unico compito è prendere delle richieste utente, "
+    "spesso brevi o ambigue, e trasformare ciascuna in una query di ricerca dettagliata e semanticamente ricca. "
+    "Le query ottimizzate devono essere ideali per una ricerca vettoriale in una base di conoscenza tecnica. "
+    "NON rispondere alle domande, ma RIFORMULALE una per una, in modo indipendente.\n"
+    "Restituisci solo ed esclusivamente un array JSON di stringhe, con una query migliorata per ogni richiesta, "
+    "nello stesso ordine e nello stesso numero delle richieste ricevute, senza alcun testo di contorno."
+)
+
+# --- Salto della Riscrittura per le Query Già Specifiche (Facoltativo) ---
+# Una richiesta lunga che nomina già più concetti tecnici è in genere una buona query di ricerca così com'è:
+# riscriverla costa un intero round trip all'LLM senza migliorare il recupero. Se REWRITE_SKIP_MIN_CHARS è
+# maggiore di 0, le query di almeno quella lunghezza con almeno REWRITE_SKIP_MIN_TERMS termini tecnici
+# vengono usate senza riscrittura. 0 (predefinito) riscrive sempre.
+REWRITE_SKIP_MIN_CHARS = int(os.getenv("REWRITE_SKIP_MIN_CHARS", "0"))
+REWRITE_SKIP_MIN_TERMS = int(os.getenv("REWRITE_SKIP_MIN_TERMS", "2"))
+TERMINI_TECNICI_RE = re.compile(
+    r"\b(login|logout|2fa|api|token|oauth|sso|password|endpoint|database|dashboard|backend|frontend|"
+    r"autenticazion\w*|autorizzazion\w*|registrazion\w*|notific\w*|pagament\w*|permess\w*|ruol\w*|"
+    r"profil\w*|account|sessione|user story|report\w*|esport\w*|import\w*|integrazion\w*)\b",
+    re.IGNORECASE
+)
+
+# Token massimi generati per ogni query riscritta: una query ottimizzata è lunga qualche decina di token, e il
+# limite evita che un modello poco disciplinato prosegua con spiegazioni (il costo della generazione cresce con
+# i token prodotti). La riscrittura in blocco ne concede altrettanti per ogni query del blocco.
+REWRITE_MAX_TOKENS = int(os.getenv("REWRITE_MAX_TOKENS", "128"))
+
+# Query già riscritte nel processo corrente, per (query, modello): una richiesta ripetuta (es. nel chatbot)
+# non ripete la chiamata all'LLM. Vengono memorizzate solo le riscritture riuscite.
+_riscritture: dict[tuple[str, str], str] = {}
+
+def query_gia_specifica(user_query: str) -> bool:
+    """
+    Indica se la query è abbastanza lunga e tecnica da poter saltare la riscrittura.
+
+    Args:
+        user_query (str): La query originale dell'utente.
+
+    Returns:
+        bool: True se la riscrittura può essere saltata (sempre False se REWRITE_SKIP_MIN_CHARS è 0).
+    """
+    if REWRITE_SKIP_MIN_CHARS <= 0 or len(user_query) < REWRITE_SKIP_MIN_CHARS:
+        return False
+    return len(TERMINI_TECNICI_RE.findall(user_query)) >= REWRITE_SKIP_MIN_TERMS
+
+def _pulisci_riscrittura(testo: str) -> str | None:
+    """
+    Pulisce una query riscritta dall'LLM e ne verifica la validità.
+
+    Args:
+        testo (str): Il testo generato per una query.
+
+    Returns:
+        str | None: La query senza spazi iniziali/finali e virgolette, oppure None se è vuota o composta dalla sola
+            introduzione (es. "Ecco la query ottimizzata:", che alcuni modelli locali premettono nonostante il prompt).
+    """
+    query = str(testo).strip().replace('"', '')
+    if not query or query.endswith(':'):
+        return None
+    return query
+
+@lru_cache(maxsize=None)
+def _client_azure() -> AzureOpenAI:
+    """
+    Crea (alla prima chiamata) e restituisce il client di Azure OpenAI condiviso da tutte le riscritture:
+    le richieste successive riutilizzano le connessioni HTTPS già aperte invece di ripetere l'handshake TLS.
+    Il client è thread-safe, quindi può essere usato anche dalle riscritture in parallelo di 03_valuta_modello.py.
+
+    Returns:
+        AzureOpenAI: Il client configurato con le credenziali dalle variabili d'ambiente.
+    """
+    # Throttling (429), timeout ed errori temporanei vengono ripetuti con attesa esponenziale.
+    return AzureOpenAI(
+        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+        api_version="2024-02-01",
+        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+        max_retries=int(os.getenv("AZURE_OPENAI_MAX_RETRIES", "6")),
+        timeout=float(os.getenv("AZURE_OPENAI_TIMEOUT", "60"))
+    )
+
+def _genera(model_name: str, system_prompt: str, user_prompt: str, max_tokens: int) -> str:
+    """
+    Invia una coppia di prompt (sistema e utente) all'LLM indicato e ne restituisce la risposta testuale.
+    La generazione è deterministica (temperatura 0), come si addice a una riformulazione.
+
+    Args:
+        model_name (str): L'identificatore dell'LLM ("azure" o "ollama").
+        system_prompt (str): Il prompt di sistema.
+        user_prompt (str): Il prompt dell'utente.
+        max_tokens (int): Il numero massimo di token da generare.
+
+    Returns:
+        str: Il testo generato dall'LLM.
+    """
+    if model_name == "azure":
+        client = _client_azure()
+        # Invia la richiesta all'API di Azure OpenAI con i prompt specializzati per la riscrittura.
+        response = client.chat.completions.create(
+            model=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME", "gpt-4o"), # Legge il nome del deployment da .env
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            max_tokens=max_tokens,
+            temperature=0
+        )
+        return response.choices[0].message.content
+
+    # Legge il nome del modello locale da .env, con un fallback a un valore predefinito.
+    ollama_model = os.getenv("OLLAMA_MODEL_NAME", "llama3.2:latest")
+    print(f"   - Tento la riformulazione con il modello Ollama: '{ollama_model}'")
+
+    # Invia la richiesta al servizio Ollama locale. 'ollama.chat' usa il client predefinito del modulo
+    # (host da OLLAMA_HOST), creato una sola volta e riutilizzato a ogni chiamata.
+    response = ollama.chat(
+        model=ollama_model,
+        messages=[
+            {'role': 'system', 'content': system_prompt},
+            {'role': 'user', 'content': user_prompt},
+        ],
+        options={"num_predict": max_tokens, "temperature": 0}
+    )
+    return response['message']['content']
+
 def rewrite_query(user_query: str, model_name: str) -> str:
     """
     Usa un Large Language Model (LLM) per espandere e migliorare la query di un utente per ottenere risultati di recupero migliori.
@@ -20,20 +160,16 @@ def rewrite_query(user_query: str, model_name: str) -> str:
         str: La query riscritta e ottimizzata per la ricerca semantica. Se si verifica un errore,
              restituisce la query originale dell'utente come fallback.
     """
+    if (user_query, model_name) in _riscritture:
+        print(f"   - Query già riformulata in precedenza: '{_riscritture[(user_query, model_name)]}'")
+        return _riscritture[(user_query, model_name)]
+    if query_gia_specifica(user_query):
+        print(f"   - Query già specifica, uso la query originale: '{user_query}'")
+        return user_query
+
     # Mantiene l'output della console in italiano per l'utente.
     print(f"   - Riformulo la query originale: '{user_query}'...")
 
-    # Questo è un "meta-prompt" progettato specificamente per il compito di riscrittura.
-    # Istruisce l'LLM ad agire come un esperto di recupero dell'informazione e a
-    # riformulare soltanto la query, non a rispondere. Ciò garantisce che l'output sia pulito e mirato.
-    system_prompt_for_rewriting = (
-        "Sei un assistente AI esperto in information retrieval. Il tuo unico compito è prendere una richiesta utente, "
-        "spesso breve o ambigua, e trasformarla in una query di ricerca dettagliata e semanticamente ricca. "
-        "La query ottimizzata deve essere ideale per una ricerca vettoriale in una base di conoscenza tecnica. "
-        "NON rispondere alla domanda, ma RIFORMULALA.\n"
-        "Restituisci solo ed esclusivamente la query migliorata, senza alcuna frase introduttiva o di contorno."
-    )
-    
     # Il prompt per l'utente combina l'istruzione statica con la query dinamica dell'utente.
     user_prompt_for_rewriting = f"Riscrivi e ottimizza la seguente richiesta per una ricerca semantica: \"{user_query}\""
     
@@ -41,55 +177,79 @@ def rewrite_query(user_query: str, model_name: str) -> str:
     # Se si verifica un errore, la funzione ripiegherà sull'uso della query originale,
     # garantendo che la pipeline RAG non si blocchi.
     try:
-        rewritten_query = ""
         # --- Logica di Selezione del Modello ---
         # Seleziona il servizio LLM appropriato in base al parametro 'model_name'.
-
-        if model_name == "azure":
-            # Inizializza il client di Azure OpenAI usando le credenziali dalle variabili d'ambiente.
-            client = AzureOpenAI(
-                api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-                api_version="2024-02-01",
-                azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
-            )
-            # Invia la richiesta all'API di Azure OpenAI con i prompt specializzati per la riscrittura.
-            response = client.chat.completions.create(
-                model=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME", "gpt-4o"), # Legge il nome del deployment da .env
-                messages=[
-                    {"role": "system", "content": system_prompt_for_rewriting},
-                    {"role": "user", "content": user_prompt_for_rewriting}
-                ]
-            )
-            rewritten_query = response.choices[0].message.content
-
-        elif model_name == "ollama":
-            # Legge il nome del modello locale da .env, con un fallback a un valore predefinito.
-            ollama_model = os.getenv("OLLAMA_MODEL_NAME", "llama3.2:latest")
-            print(f"   - Tento la riformulazione con il modello Ollama: '{ollama_model}'")
-            
-            # Invia la richiesta al servizio Ollama locale.
-            response = ollama.chat(
-                model=ollama_model,
-                messages=[
-                    {'role': 'system', 'content': system_prompt_for_rewriting},
-                    {'role': 'user', 'content': user_prompt_for_rewriting},
-                ]
-            )
-            rewritten_query = response['message']['content']
-            
-        else:
+        if model_name not in ("azure", "ollama"):
             # Se il model_name non è riconosciuto, salta la riscrittura e restituisce la query originale.
             print(f"   - ATTENZIONE: Modello '{model_name}' non valido. Uso la query originale.")
             return user_query
+        rewritten_query = _genera(model_name, SYSTEM_PROMPT_RISCRITTURA, user_prompt_for_rewriting,
+                                  max_tokens=REWRITE_MAX_TOKENS)
 
         # --- Elaborazione Finale ---
-        # Pulisce la risposta dell'LLM rimuovendo spazi bianchi iniziali/finali e qualsiasi virgoletta
-        # per garantire che una query pulita venga passata all'indice di ricerca.
-        final_query = rewritten_query.strip().replace('"', '')
+        # Pulisce la risposta dell'LLM, così una query pulita viene passata all'indice di ricerca.
+        # Una riformulazione non valida non viene salvata: si usa la query originale.
+        final_query = _pulisci_riscrittura(rewritten_query)
+        if final_query is None:
+            print(f"   - ATTENZIONE: riformulazione non valida ('{rewritten_query.strip()}'). Uso la query originale.")
+            return user_query
         print(f"   - Query ottimizzata: '{final_query}'")
+        _riscritture[(user_query, model_name)] = final_query
         return final_query
 
     except Exception as e:
         # Se si verifica un'eccezione durante la chiamata API, registra l'errore e restituisce la query originale.
         print(f"   - ERRORE durante la riformulazione della query: {e}. Verrà usata la query originale.")
-        return user_query
\ No newline at end of file
+        return user_query
+
+def rewrite_queries_bulk(user_queries: list[str], model_name: str) -> list[str]:
+    """
+    Riscrive più query con una sola chiamata all'LLM, invece di una chiamata per query.
+    Utile quando tutte le domande sono note in anticipo, come nella valutazione sul golden dataset.
+
+    Args:
+        user_queries (list[str]): Le query originali degli utenti.
+        model_name (str): L'identificatore per l'LLM da usare per la riscrittura (es. "azure" o "ollama").
+
+    Returns:
+        list[str]: Le query riscritte, nello stesso ordine. Se la risposta dell'LLM non è un array JSON
+                   della lunghezza attesa, ripiega sulla riscrittura di una query alla volta.
+    """
+    if not user_queries:
+        return []
+    if model_name not in ("azure", "ollama"):
+        print(f"   - ATTENZIONE: Modello '{model_name}' non valido. Uso le query originali.")
+        return list(user_queries)
+
+    # Le query già riscritte o già specifiche non vengono inviate all'LLM.
+    da_riscrivere = [
+        query for query in dict.fromkeys(user_queries)
+        if (query, model_name) not in _riscritture and not query_gia_specifica(query)
+    ]
+    if len(da_riscrivere) < len(set(user_queries)):
+        riscritte = dict(zip(da_riscrivere, rewrite_queries_bulk(da_riscrivere, model_name)))
+        return [riscritte.get(query) or _riscritture.get((query, model_name), query) for query in user_queries]
+
+    print(f"   - Riformulo {len(user_queries)} query con una sola richiesta...")
+    richieste = "\n".join(f"{i}. \"{query}\"" for i, query in enumerate(user_queries, start=1))
+    user_prompt = f"Riscrivi e ottimizza ciascuna delle seguenti {len(user_queries)} richieste per una ricerca semantica:\n{richieste}"
+
+    try:
+        risposta = _genera(model_name, SYSTEM_PROMPT_RISCRITTURA_MULTIPLA, user_prompt,
+                           max_tokens=REWRITE_MAX_TOKENS * len(user_queries) + 32).strip()
+        # Alcuni modelli racchiudono comunque il JSON in un blocco di codice markdown: si considera solo l'array.
+        rewritten_queries = json.loads(risposta[risposta.find("["):risposta.rfind("]") + 1])
+        if not isinstance(rewritten_queries, list) or len(rewritten_queries) != len(user_queries):
+            raise ValueError(f"attese {len(user_queries)} query, ricevuto: {risposta[:200]}")
+        # Ogni elemento passa dalla stessa validazione della riscrittura singola: quelli non validi ripiegano sulla
+        # query originale e non vengono salvati nella cache.
+        pulite = [_pulisci_riscrittura(query) for query in rewritten_queries]
+        non_valide = pulite.count(None)
+        if non_valide:
+            print(f"   - ATTENZIONE: {non_valide} riformulazioni non valide. Per quelle uso la query originale.")
+        _riscritture.update(((originale, model_name), query) for originale, query in zip(user_queries, pulite) if query is not None)
+        return [query if query is not None else originale for query, originale in zip(pulite, user_queries)]
+
+    except Exception as e:
+        print(f"   - ERRORE durante la riformulazione multipla: {e}. Riformulo le query una alla volta.")
+        return [rewrite_query(query, model_name) for query in user_queries]
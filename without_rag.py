@@ -1,9 +1,12 @@
 import os
 import sys
 import json
+import hashlib
 import ollama # Importiamo direttamente ollama
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
 
 # --- SOLUZIONE PER L'IMPORT ---
@@ -12,66 +15,89 @@ sys.path.append(script_directory)
 
 # --- Import dei moduli necessari ---
 from dotenv import load_dotenv
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
+from embedding import load_embedding_model
+import numpy as np
 
 # --- CONFIGURAZIONE ---
 MODELLO_VALUTATO = "OLLAMA (Senza RAG)"
 OLLAMA_MODEL_NAME = 'llama3.2:latest'
+# Richieste di generazione inviate in parallelo al server Ollama (la stessa variabile di 03_valuta_modello.py).
+# Il server le elabora contemporaneamente fino a OLLAMA_NUM_PARALLEL (impostazione del server Ollama);
+# quelle in eccesso restano in coda sul server.
+EVAL_WORKERS = int(os.getenv("EVAL_WORKERS", "4"))
+# File (facoltativo) in cui conservare le risposte generate, indicizzate per hash di modello e prompt: una nuova
+# esecuzione non ripete le chiamate a Ollama per le domande già elaborate con lo stesso modello e gli stessi prompt.
+# Vuota (predefinito) disattiva la cache, come EVAL_RAG_CACHE in 03_valuta_modello.py.
+WITHOUT_RAG_CACHE = os.getenv("WITHOUT_RAG_CACHE", "")
+# Token massimi (facoltativi) generati per ogni risposta: il costo della generazione cresce con i token prodotti.
+# 0 (predefinito) non pone limiti, come WRITER_MAX_TOKENS per i writer della pipeline RAG: un limite applicato
+# a uno solo dei due esperimenti falserebbe il confronto, quindi va impostato lo stesso valore in entrambe le
+# variabili. Le risposte troncate vengono segnalate.
+WITHOUT_RAG_MAX_TOKENS = int(os.getenv("WITHOUT_RAG_MAX_TOKENS", "0"))
+# Se false, il confronto tra risposta ideale e generata non viene stampato per ogni item (utile con dataset grandi).
+WITHOUT_RAG_VERBOSE = os.getenv("WITHOUT_RAG_VERBOSE", "true").lower() == "true"
 # ---
 
+# --- Stili del Report Excel ---
+# Creati una sola volta a livello di modulo e condivisi da tutte le celle del report.
+HEADER_FONT = Font(bold=True, color="FFFFFF")
+HEADER_FILL = PatternFill(start_color="C00000", end_color="C00000", fill_type="solid") # Colore rosso per distinguerlo
+HEADER_ALIGNMENT = Alignment(horizontal="center", vertical="center", wrap_text=True)
+THIN_BORDER = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+# Stile comune a tutte le celle di dati.
+DATA_STYLE = {"alignment": Alignment(wrap_text=True, vertical="top"), "border": THIN_BORDER}
+# Stili della sezione di riepilogo.
+TITLE_FONT = Font(bold=True, size=14)
+SUBTITLE_FONT = Font(bold=True, size=12)
+BOLD_FONT = Font(bold=True)
+SCORE_FONT = Font(bold=True, color="00B050")
+
 # ... (La funzione salva_report_excel rimane invariata) ...
 def salva_report_excel(risultati, punteggio_medio_totale, risultati_cat):
     print(f"\n💾 Salvataggio del report Excel per '{MODELLO_VALUTATO}'...")
     try:
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Report Valutazione SENZA RAG"
-
-        headers = ["Categoria", "Domanda", "Risposta Ideale", "Risposta Generata (Senza RAG)", "Punteggio Similarità"]
-        ws.append(headers)
-        
-        header_font = Font(bold=True, color="FFFFFF")
-        header_fill = PatternFill(start_color="C00000", end_color="C00000", fill_type="solid") # Colore rosso per distinguerlo
-        
-        for cell in ws[1]:
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
-
-        for item in risultati:
-            ws.append([item["categoria"], item["domanda"], item["risposta_ideale"], item["risposta_generata"], f'{item["score"]:.4f}'])
+        # Modalità write-only: le righe vengono scritte in streaming invece di restare in memoria come
+        # oggetti Cell, e ogni cella riceve il proprio stile nel momento in cui viene scritta.
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("Report Valutazione SENZA RAG")
 
-        thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-        for row in ws.iter_rows(min_row=2, max_row=len(risultati)+1):
-            for cell in row:
-                cell.alignment = Alignment(wrap_text=True, vertical="top")
-                cell.border = thin_border
+        def cella(value, **stile):
+            c = WriteOnlyCell(ws, value=value)
+            for attributo, valore in stile.items():
+                setattr(c, attributo, valore)
+            return c
 
+        # In write-only le larghezze vanno impostate prima di scrivere le righe.
         ws.column_dimensions['A'].width = 20
         ws.column_dimensions['B'].width = 60
         ws.column_dimensions['C'].width = 60
         ws.column_dimensions['D'].width = 60
         ws.column_dimensions['E'].width = 20
-        
+
+        # Gli stili sono le costanti di modulo, condivise da tutte le celle.
+        headers = ["Categoria", "Domanda", "Risposta Ideale", "Risposta Generata (Senza RAG)", "Punteggio Similarità"]
+        ws.append([cella(h, font=HEADER_FONT, fill=HEADER_FILL, alignment=HEADER_ALIGNMENT) for h in headers])
+
+        for item in risultati:
+            valori = [item["categoria"], item["domanda"], item["risposta_ideale"], item["risposta_generata"], f'{item["score"]:.4f}']
+            ws.append([cella(valore, **DATA_STYLE) for valore in valori])
+
+        # Riepilogo dopo due righe vuote.
         start_row = len(risultati) + 4
-        ws.cell(row=start_row, column=1, value="Riepilogo Valutazione").font = Font(bold=True, size=14)
-        ws.merge_cells(start_row=start_row, start_column=1, end_row=start_row, end_column=2)
-        
-        ws.cell(row=start_row + 1, column=1, value="Modello Utilizzato:").font = Font(bold=True)
-        ws.cell(row=start_row + 1, column=2, value=MODELLO_VALUTATO)
+        ws.append([])
+        ws.append([])
+        ws.append([cella("Riepilogo Valutazione", font=TITLE_FONT)])
+        ws.merged_cells.add(f"A{start_row}:B{start_row}")
         
-        ws.cell(row=start_row + 2, column=1, value="Punteggio Medio Globale:").font = Font(bold=True)
-        ws.cell(row=start_row + 2, column=2, value=f"{punteggio_medio_totale:.4f}").font = Font(bold=True, color="00B050")
+        ws.append([cella("Modello Utilizzato:", font=BOLD_FONT), MODELLO_VALUTATO])
+        ws.append([cella("Punteggio Medio Globale:", font=BOLD_FONT), cella(f"{punteggio_medio_totale:.4f}", font=SCORE_FONT)])
+        ws.append([])
         
-        ws.cell(row=start_row + 4, column=1, value="Punteggi Medi per Categoria").font = Font(bold=True, size=12)
-        ws.merge_cells(start_row=start_row+4, start_column=1, end_row=start_row+4, end_column=2)
+        ws.append([cella("Punteggi Medi per Categoria", font=SUBTITLE_FONT)])
+        ws.merged_cells.add(f"A{start_row + 4}:B{start_row + 4}")
 
-        cat_row = start_row + 5
         for categoria, punteggio in risultati_cat.items():
-            ws.cell(row=cat_row, column=1, value=f"Categoria '{categoria}'")
-            ws.cell(row=cat_row, column=2, value=f"{punteggio:.4f}").font = Font(bold=True)
-            cat_row += 1
+            ws.append([f"Categoria '{categoria}'", cella(f"{punteggio:.4f}", font=BOLD_FONT)])
             
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         file_name = f'report_valutazione_SENZA_RAG_{timestamp}.xlsx'
@@ -81,13 +107,53 @@ def salva_report_excel(risultati, punteggio_medio_totale, risultati_cat):
     except Exception as e:
         print(f"❌ ERRORE durante il salvataggio del report Excel: {e}")
 
+# Usiamo un prompt di sistema generico e semplice
+SYSTEM_PROMPT_DIRETTO = "Il tuo compito è generare User Story."
+
+def prompt_utente(domanda: str) -> str:
+    return f"Genera una o più user story complete per la seguente richiesta: \"{domanda}\""
+
+def chiave_cache(domanda: str) -> str:
+    """
+    Calcola la chiave della risposta in WITHOUT_RAG_CACHE: cambia se cambiano il modello, il limite di token o uno dei prompt.
+
+    Args:
+        domanda (str): La domanda del golden dataset.
+
+    Returns:
+        str: L'hash esadecimale di modello, limite di token, prompt di sistema e prompt utente.
+    """
+    return hashlib.blake2b(f"{OLLAMA_MODEL_NAME}|{WITHOUT_RAG_MAX_TOKENS}|{SYSTEM_PROMPT_DIRETTO}|{prompt_utente(domanda)}".encode("utf-8"), digest_size=16).hexdigest()
+
+def carica_cache_generazioni() -> dict[str, str]:
+    """
+    Legge dal file WITHOUT_RAG_CACHE le risposte salvate nelle esecuzioni precedenti.
+
+    Returns:
+        dict[str, str]: La mappa chiave -> risposta generata (vuota se la cache è disattivata o assente).
+    """
+    if not WITHOUT_RAG_CACHE or not os.path.exists(WITHOUT_RAG_CACHE):
+        return {}
+    try:
+        with open(WITHOUT_RAG_CACHE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Attenzione: impossibile leggere la cache '{WITHOUT_RAG_CACHE}' ({e}). Tutte le risposte verranno rigenerate.")
+        return {}
+
+def salva_cache_generazioni(cache: dict[str, str]) -> None:
+    # Scrive prima in un file temporaneo: un'interruzione non lascia una cache corrotta.
+    file_temporaneo = f"{WITHOUT_RAG_CACHE}.tmp"
+    with open(file_temporaneo, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, ensure_ascii=False, indent=2)
+    os.replace(file_temporaneo, WITHOUT_RAG_CACHE)
+
 # --- MODIFICA CHIAVE QUI ---
 def esegui_generazione_diretta(domanda: str) -> str:
     print(f"   - Eseguo la generazione diretta (SENZA RAG, prompt semplice) per: '{domanda}'")
     
-    # Usiamo un prompt di sistema generico e semplice
-    system_prompt = "Il tuo compito è generare User Story."
-    user_prompt = f"Genera una o più user story complete per la seguente richiesta: \"{domanda}\""
+    system_prompt = SYSTEM_PROMPT_DIRETTO
+    user_prompt = prompt_utente(domanda)
     
     try:
         response = ollama.chat(
@@ -95,8 +161,11 @@ def esegui_generazione_diretta(domanda: str) -> str:
             messages=[
                 {'role': 'system', 'content': system_prompt},
                 {'role': 'user', 'content': user_prompt},
-            ]
+            ],
+            options={'num_predict': WITHOUT_RAG_MAX_TOKENS or -1}
         )
+        if response.get('done_reason') == "length":
+            print(f"   - ⚠️ Risposta troncata a WITHOUT_RAG_MAX_TOKENS={WITHOUT_RAG_MAX_TOKENS} token per: '{domanda}'")
         return response['message']['content']
     except Exception as e:
         print(f"Errore durante la chiamata a Ollama: {e}")
@@ -118,60 +187,115 @@ except FileNotFoundError:
     sys.exit()
 
 print("🔎 Caricamento del modello di embedding per la valutazione...")
-model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
+# Stesso modello e stessa configurazione di 03_valuta_modello.py (vedi embedding.py), così i punteggi dei due
+# esperimenti restano confrontabili. Con EMBEDDING_BACKEND="onnx" e un file quantizzato (es.
+# EMBEDDING_MODEL_FILE="model_qint8_avx512_vnni.onnx") il calcolo dei punteggi usa ONNX Runtime in int8.
+model = load_embedding_model()
 print("✅ Modello caricato.")
 
 risultati_per_export = []
-risultati_per_categoria = {}
+# Posizioni (in 'risultati_per_export') delle risposte generate senza errori, da confrontare con quelle ideali.
+indici_validi = []
+# Generazioni fallite: non ricevono un punteggio di similarità.
+risposte_con_errore = 0
 
 print("\n🚀 Avvio del ciclo di valutazione sul Golden Dataset...")
-for i, item in enumerate(golden_dataset):
-    categoria = item['categoria']
-    domanda_test = item["domanda"]
-    risposta_ideale = item["risposta_ideale"]
+# Le generazioni sono chiamate di rete indipendenti: vengono inviate tutte in parallelo sul pool di thread,
+# e il ciclo ne attende i risultati nell'ordine del dataset, quindi stampe e report restano nello stesso ordine.
+# Le domande già presenti in WITHOUT_RAG_CACHE non vengono inviate a Ollama.
+cache_generazioni = carica_cache_generazioni()
+chiavi = [chiave_cache(item["domanda"]) for item in golden_dataset]
+nuove_risposte = {}
+with ThreadPoolExecutor(max_workers=EVAL_WORKERS) as executor:
+    generazioni = [None if chiave in cache_generazioni else executor.submit(esegui_generazione_diretta, item["domanda"])
+                   for chiave, item in zip(chiavi, golden_dataset)]
+    if cache_generazioni:
+        print(f"Risposte riutilizzate dalla cache: {generazioni.count(None)}/{len(golden_dataset)}.")
 
-    print(f"\n--- Valutando l'item {i+1}/{len(golden_dataset)} (Categoria: {categoria}) ---")
+    for i, item in enumerate(golden_dataset):
+        categoria = item['categoria']
+        domanda_test = item["domanda"]
+        risposta_ideale = item["risposta_ideale"]
 
-    try:
-        risposta_generata = esegui_generazione_diretta(domanda_test)
-        
-        print("\n" + "="*20 + " CONFRONTO RISPOSTE (SENZA RAG) " + "="*20)
-        print(f"DOMANDA        : {domanda_test}")
-        print(f"RISPOSTA IDEALE  :\n{risposta_ideale}\n")
-        print(f"RISPOSTA GENERATA:\n{risposta_generata.strip()}")
-        print("="*72 + "\n")
+        print(f"\n--- Valutando l'item {i+1}/{len(golden_dataset)} (Categoria: {categoria}) ---")
+
+        try:
+            if generazioni[i] is None:
+                risposta_generata = cache_generazioni[chiavi[i]].strip()
+            else:
+                risposta_generata = generazioni[i].result().strip()
+                # Le risposte con errore non vengono salvate, così la prossima esecuzione le rigenera.
+                if not risposta_generata.startswith("ERRORE"):
+                    nuove_risposte[chiavi[i]] = risposta_generata
         
-        embedding_generato = model.encode([risposta_generata])
-        embedding_ideale = model.encode([risposta_ideale])
-        score = cosine_similarity(embedding_generato, embedding_ideale)[0][0]
+            if WITHOUT_RAG_VERBOSE:
+                # Un'unica scrittura per l'intero blocco di confronto.
+                print("\n" + "="*20 + " CONFRONTO RISPOSTE (SENZA RAG) " + "="*20 + "\n"
+                      f"DOMANDA        : {domanda_test}\n"
+                      f"RISPOSTA IDEALE  :\n{risposta_ideale}\n\n"
+                      f"RISPOSTA GENERATA:\n{risposta_generata}\n"
+                      + "="*72 + "\n")
         
-        print(f"   - Punteggio di Similarità Semantica: {score:.4f}")
+            # Il punteggio viene calcolato dopo il ciclo, per tutte le risposte insieme. Le generazioni fallite
+            # (esegui_generazione_diretta restituisce "ERRORE: ...") non vengono codificate e mantengono punteggio 0.
+            if risposta_generata.startswith("ERRORE"):
+                risposte_con_errore += 1
+            else:
+                indici_validi.append(i)
         
-    except Exception as e:
-        print(f"\n❌ Si è verificato un errore inatteso: {e}\n")
-        score = 0.0
-        risposta_generata = f"ERRORE: {e}"
-
-    risultati_per_export.append({
-        "categoria": categoria,
-        "domanda": domanda_test,
-        "risposta_ideale": risposta_ideale,
-        "risposta_generata": risposta_generata.strip(),
-        "score": score
-    })
-    
-    if categoria not in risultati_per_categoria:
-        risultati_per_categoria[categoria] = []
-    risultati_per_categoria[categoria].append(score)
+        except Exception as e:
+            print(f"\n❌ Si è verificato un errore inatteso: {e}\n")
+            risposta_generata = f"ERRORE: {e}"
+            risposte_con_errore += 1
+
+        risultati_per_export.append({
+            "categoria": categoria,
+            "domanda": domanda_test,
+            "risposta_ideale": risposta_ideale,
+            "risposta_generata": risposta_generata,
+            "score": 0.0
+        })
+
+if WITHOUT_RAG_CACHE and nuove_risposte:
+    cache_generazioni.update(nuove_risposte)
+    salva_cache_generazioni(cache_generazioni)
+    print(f"Cache aggiornata con {len(nuove_risposte)} nuove risposte.")
+
+# --- Calcolo dei Punteggi di Similarità ---
+# Risposte generate e ideali vengono codificate con due sole chiamate batch. Con embedding normalizzati
+# la similarità del coseno coincide con il prodotto scalare, calcolato riga per riga su tutte le coppie.
+if indici_validi:
+    print("🧮 Calcolo dei punteggi di similarità semantica...")
+    # I punteggi vengono accumulati in float32 anche se il modello produce vettori float16 (fp16 su GPU CUDA).
+    embedding_generati = model.encode([risultati_per_export[j]["risposta_generata"] for j in indici_validi], batch_size=64, normalize_embeddings=True).astype(np.float32, copy=False)
+    embedding_ideali = model.encode([risultati_per_export[j]["risposta_ideale"] for j in indici_validi], batch_size=64, normalize_embeddings=True).astype(np.float32, copy=False)
+    punteggi = np.einsum('ij,ij->i', embedding_generati, embedding_ideali)
+    for j, score in zip(indici_validi, punteggi.tolist()):
+        risultati_per_export[j]["score"] = score
+        print(f"   - Item {j+1}: Punteggio di Similarità Semantica = {score:.4f}")
+
+# --- Calcolo Finale dei Punteggi ---
+# Le categorie vengono codificate come indici interi: somme e conteggi di tutte le categorie si ottengono con
+# np.bincount in un'unica passata vettoriale. Scelta esplicita: le generazioni fallite restano nei denominatori
+# con punteggio 0, quindi le medie sono calcolate sull'intero golden dataset e restano confrontabili con i report
+# precedenti. A differenza di 03_valuta_modello.py, che esclude dalle medie le risposte escluse; il numero di
+# generazioni fallite viene stampato nel riepilogo.
+categorie, id_categorie = np.unique([risultato["categoria"] for risultato in risultati_per_export], return_inverse=True)
+punteggi_elementi = np.array([risultato["score"] for risultato in risultati_per_export], dtype=np.float64)
+campioni_per_categoria = np.bincount(id_categorie, minlength=len(categorie))
+somme_per_categoria = np.bincount(id_categorie, weights=punteggi_elementi, minlength=len(categorie))
 
-punteggio_medio = sum(score['score'] for score in risultati_per_export) / len(risultati_per_export) if risultati_per_export else 0
-punteggi_medi_categoria = {cat: sum(scores) / len(scores) for cat, scores in risultati_per_categoria.items()}
+punteggio_medio = float(punteggi_elementi.mean()) if risultati_per_export else 0
+punteggi_medi_categoria = {str(cat): float(somma / campioni) for cat, somma, campioni in zip(categorie, somme_per_categoria, campioni_per_categoria)}
+campioni_categoria = {str(cat): int(campioni) for cat, campioni in zip(categorie, campioni_per_categoria)}
 
 print("\n\n--- RISULTATI FINALI DELLA VALUTAZIONE ---")
 print(f"Modello Valutato: {MODELLO_VALUTATO}")
 print(f"📈 Punteggio Medio di Similarità Semantica: {punteggio_medio:.4f}")
+if risposte_con_errore:
+    print(f"⚠️ Generazioni fallite (contate con punteggio 0): {risposte_con_errore}/{len(risultati_per_export)}")
 print("\n--- ANALISI DETTAGLIATA PER CATEGORIA ---")
 for categoria, punteggio in punteggi_medi_categoria.items():
-    print(f"📊 Categoria '{categoria}': Punteggio Medio = {punteggio:.4f} ({len(risultati_per_categoria[categoria])} campioni)")
+    print(f"📊 Categoria '{categoria}': Punteggio Medio = {punteggio:.4f} ({campioni_categoria[categoria]} campioni)")
 
 salva_report_excel(risultati_per_export, punteggio_medio, punteggi_medi_categoria)
@@ -4,6 +4,7 @@
 # and calls the specified GPT model deployment to generate the final user story.
 
 import os
+from functools import lru_cache
 from openai import AzureOpenAI
 from dotenv import load_dotenv
 
@@ -14,26 +15,50 @@ load_dotenv()
 # IMPORTANT: This must be the *deployment name* you created in the Azure AI Studio,
 # not the base model name (e.g., "gpt-4o").
 AZURE_OPENAI_DEPLOYMENT_NAME = "gpt-4o"
+# Optional maximum number of tokens generated per answer (generation time grows with the tokens produced).
+# 0 (default) leaves the answer unbounded: a cap can cut a long multi-story answer mid-sentence, which lowers
+# its scores in the evaluation. Truncated answers are reported on the console.
+WRITER_MAX_TOKENS = int(os.getenv("WRITER_MAX_TOKENS", "0"))
+
+# Returned instead of the answer when the API call fails. The evaluation scripts compare against it,
+# so that a failed generation is not cached or scored as a real answer.
+ERROR_MESSAGE = "An error occurred while generating the response with Azure OpenAI."
 # ---
 
-def write(productContext: str, assignment: str) -> str:
+@lru_cache(maxsize=None)
+def _get_client() -> AzureOpenAI:
+    """
+    Creates the Azure OpenAI client on the first call and returns the same instance afterwards,
+    so consecutive generations reuse the open HTTPS connections instead of repeating the TLS handshake.
+
+    Returns:
+        AzureOpenAI: The client configured with the credentials from the environment variables.
+    """
+    # Rate limits (429), timeouts and transient server errors are retried with exponential backoff.
+    return AzureOpenAI(
+        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+        api_version="2024-02-01",
+        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+        max_retries=int(os.getenv("AZURE_OPENAI_MAX_RETRIES", "6")),
+        timeout=float(os.getenv("AZURE_OPENAI_TIMEOUT", "60"))
+    )
+
+def write(productContext: str, assignment: str, stream: bool = False) -> str:
     """
     Generates a response using a model deployed on Azure OpenAI.
     
     Args:
         productContext (str): The context retrieved from the knowledge base.
         assignment (str): The original user query.
+        stream (bool): If True, prints the tokens to the console as they arrive.
+            The complete text is returned in both cases. Defaults to False.
         
     Returns:
         str: The user story generated by the model.
     """
     try:
-        # Initialize the Azure OpenAI client using credentials from environment variables.
-        client = AzureOpenAI(
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            api_version="2024-02-01",
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
-        )
+        # The client is shared by all calls (see _get_client).
+        client = _get_client()
 
         # Construct the message payload for the chat completions API.
         response = client.chat.completions.create(
@@ -59,9 +84,29 @@ def write(productContext: str, assignment: str) -> str:
                         f'# Task\nBased ON THE PROVIDED CONTEXT, generate a complete user story for the following request: "{assignment}"'
                     )
                 }
-            ]
+            ],
+            max_tokens=WRITER_MAX_TOKENS or None,
+            stream=stream
         )
-        return response.choices[0].message.content
+        if not stream:
+            if response.choices[0].finish_reason == "length":
+                print(f"Warning: the answer was truncated at WRITER_MAX_TOKENS={WRITER_MAX_TOKENS} tokens.")
+            return response.choices[0].message.content
+
+        # With streaming, the response is an iterator of chunks, each carrying a fragment of the text.
+        # Some chunks (e.g. the content filter results sent first by Azure) have no choices or no content.
+        parts = []
+        finish_reason = None
+        for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                print(chunk.choices[0].delta.content, end="", flush=True)
+                parts.append(chunk.choices[0].delta.content)
+            if chunk.choices and chunk.choices[0].finish_reason:
+                finish_reason = chunk.choices[0].finish_reason
+        print()
+        if finish_reason == "length":
+            print(f"Warning: the answer was truncated at WRITER_MAX_TOKENS={WRITER_MAX_TOKENS} tokens.")
+        return "".join(parts)
     except Exception as e:
         print(f"Error during Azure OpenAI API call: {e}")
-        return "An error occurred while generating the response with Azure OpenAI."
+        return ERROR_MESSAGE
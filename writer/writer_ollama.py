@@ -3,20 +3,29 @@
 # served by Ollama. It constructs a detailed prompt and communicates with the
 # local Ollama API to generate the final user story.
 
+import os
 import ollama
 
 # --- Model Configuration ---
 # The name of the local model you have downloaded via `ollama pull`.
 OLLAMA_MODEL_NAME = 'llama3.2:latest' 
+# Optional maximum number of tokens generated per answer (same setting as writer_azure_openai.py).
+# 0 (default) leaves the answer unbounded.
+WRITER_MAX_TOKENS = int(os.getenv("WRITER_MAX_TOKENS", "0"))
+
+# Returned instead of the answer when the call to Ollama fails (see writer_azure_openai.py).
+ERROR_MESSAGE = "Error: Could not generate a response from the local model."
 # ---
 
-def write(productContext: str, assignment: str) -> str:
+def write(productContext: str, assignment: str, stream: bool = False) -> str:
     """
     Generates a response using a local model served by Ollama.
 
     Args:
         productContext (str): The context retrieved from the knowledge base.
         assignment (str): The original user query.
+        stream (bool): If True, prints the tokens to the console as they arrive.
+            The complete text is returned in both cases. Defaults to False.
         
     Returns:
         str: The user story generated by the model.
@@ -47,13 +56,30 @@ Based ON THE PROVIDED CONTEXT, generate a complete user story for the following
             messages=[
                 {'role': 'system', 'content': system_prompt},
                 {'role': 'user', 'content': user_prompt},
-            ]
+            ],
+            options={'num_predict': WRITER_MAX_TOKENS or -1},
+            stream=stream
         )
         
         # 4. Extract and return the response text.
-        return response['message']['content']
+        if not stream:
+            if response.get('done_reason') == "length":
+                print(f"Warning: the answer was truncated at WRITER_MAX_TOKENS={WRITER_MAX_TOKENS} tokens.")
+            return response['message']['content']
+
+        # With streaming, the response is an iterator of partial messages.
+        parts = []
+        done_reason = None
+        for chunk in response:
+            print(chunk['message']['content'], end="", flush=True)
+            parts.append(chunk['message']['content'])
+            done_reason = chunk.get('done_reason') or done_reason
+        print()
+        if done_reason == "length":
+            print(f"Warning: the answer was truncated at WRITER_MAX_TOKENS={WRITER_MAX_TOKENS} tokens.")
+        return "".join(parts)
         
     except Exception as e:
         print(f"Error during Ollama API call: {e}")
-        return "Error: Could not generate a response from the local model."
+        return ERROR_MESSAGE
 